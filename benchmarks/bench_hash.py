@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.hasher import Hasher
+
+
+def legacy_hash(path):
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8192), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_files(directory, count, size_mb):
+    block = os.urandom(1024 * 1024)
+    paths = []
+    for i in range(count):
+        p = os.path.join(directory, f"bench_{i}.bin")
+        with open(p, "wb") as f:
+            for _ in range(size_mb):
+                f.write(block)
+        paths.append(p)
+    return paths
+
+
+def report(label, total_bytes, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {total_bytes / elapsed / 1e6:10.1f} MB/s  ({elapsed:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare DriveSync hashing throughput.")
+    parser.add_argument("--files", type=int, default=8)
+    parser.add_argument("--size-mb", type=int, default=128)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = make_files(tmp, args.files, args.size_mb)
+        total = args.files * args.size_mb * 1024 * 1024
+        for p in paths:
+            legacy_hash(p)
+
+        report("legacy 8 KiB loop (serial)", total, lambda: [legacy_hash(p) for p in paths])
+        for algorithm in ("md5", "blake2b"):
+            hasher = Hasher(algorithm)
+            report(f"{algorithm} 1 MiB buffer (serial)", total, lambda: [hasher.hash_file(p) for p in paths])
+            report(f"{algorithm} 1 MiB buffer (pool)", total, lambda: list(hasher.hash_many(paths)))
+            mm = Hasher(algorithm, use_mmap=True)
+            report(f"{algorithm} mmap (pool)", total, lambda: list(mm.hash_many(paths)))
+            hasher.shutdown()
+            mm.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+# The engine keeps its tracking database under the user's config directory,
+# so point that at a scratch directory before core is imported.
+BENCH_HOME = tempfile.mkdtemp(prefix="drivesync-bench-")
+os.environ["HOME"] = BENCH_HOME
+os.environ["APPDATA"] = BENCH_HOME
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.drive_client import DriveClient
+from core.sync_engine import SyncEngine, TRACKING_DB
+from core.folder_watcher import FolderWatcher
+from core.tracking_store import remove_store
+from core.rate_limit import API_RATE
+from fake_drive import FakeDriveBackend, FakeTransport
+
+FILES_PER_DIR = 100
+DIRS_PER_DIR = 100
+
+
+def make_client(backend, api_rate=None):
+    client = DriveClient(None)
+    client.transport = FakeTransport(backend)
+    if api_rate:
+        client.limiter.bucket.rate = api_rate
+    return client
+
+
+def make_tree(root, count, file_size):
+    # root/aNN/bNN/fN.bin, FILES_PER_DIR files per leaf directory. Each file
+    # starts with its index so no two files share content (and dedup stays out).
+    filler = os.urandom(max(file_size, 8))
+    paths = []
+    for i in range(count):
+        leaf = i // FILES_PER_DIR
+        d = os.path.join(root, f"a{leaf // DIRS_PER_DIR}", f"b{leaf % DIRS_PER_DIR}")
+        if i % FILES_PER_DIR == 0:
+            os.makedirs(d, exist_ok=True)
+        p = os.path.join(d, f"f{i}.bin")
+        with open(p, "wb") as f:
+            f.write(i.to_bytes(8, "little") + filler[8:file_size])
+        paths.append(p)
+    return paths
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def report(label, files, nbytes, elapsed, backend, e2e=None):
+    elapsed = max(elapsed, 1e-9)
+    calls = sum(backend.calls.values())
+    api = backend.latencies
+    line = (f"{label:<22} {files:>9} files {elapsed:8.2f}s {files / elapsed:10.1f} files/s "
+            f"{nbytes / elapsed / 1e6:8.2f} MB/s {calls / max(files, 1):7.2f} calls/file "
+            f"{backend.round_trips:>8} trips  api p50 {percentile(api, 50) * 1e3:7.1f}ms "
+            f"p99 {percentile(api, 99) * 1e3:7.1f}ms")
+    if e2e is not None:
+        line += f"  e2e p50 {percentile(e2e, 50) * 1e3:8.1f}ms p99 {percentile(e2e, 99) * 1e3:8.1f}ms"
+    if backend.errors:
+        line += f"  injected {dict(backend.errors)}"
+    print(line)
+    print(f"{'':<22} calls: {dict(backend.calls.most_common())}")
+
+
+def wait_for(predicate, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def landed(engine, backend, paths, since):
+    # Seconds from `since` until each file's current content reached the fake Drive.
+    ids = [engine.db["files"].get(p, {}).get("id") for p in paths]
+    return [backend.modified_at[i] - since for i in ids if backend.modified_at.get(i, 0) > since]
+
+
+def bench_initial(engine, backend, root, paths, file_size):
+    backend.reset_stats()
+    start = time.perf_counter()
+    since = time.monotonic()
+    engine.register_folder(root)
+    engine.sync_folder(root)
+    report("initial sync_folder", len(paths), len(paths) * file_size, time.perf_counter() - start, backend,
+           landed(engine, backend, paths, since))
+
+
+def bench_edits(engine, backend, root, paths, count, timeout):
+    # Appends to `count` files while a watcher is running and measures how
+    # long each edit takes to land in the fake Drive.
+    watcher = FolderWatcher(root, engine.enqueue_sync, engine.enqueue_delete, engine.enqueue_move,
+                            lambda: engine.request_rescan(root))
+    watcher.start()
+    try:
+        chosen = random.sample(paths, min(count, len(paths)))
+        ids = {p: engine.db["files"][p]["id"] for p in chosen}
+        backend.reset_stats()
+        written = {}
+        start = time.perf_counter()
+        for p in chosen:
+            with open(p, "ab") as f:
+                f.write(b"edit")
+            written[p] = time.monotonic()
+        done = wait_for(lambda: all(backend.modified_at.get(ids[p], 0) > written[p] for p in chosen), timeout)
+        elapsed = time.perf_counter() - start
+        e2e = [backend.modified_at[ids[p]] - written[p] for p in chosen if backend.modified_at.get(ids[p], 0) > written[p]]
+        report("watcher edits" + ("" if done else " (timeout)"), len(chosen),
+               sum(os.path.getsize(p) for p in chosen), elapsed, backend, e2e)
+    finally:
+        watcher.stop()
+
+
+def bench_delete(engine, backend, root, paths, count, timeout):
+    watcher = FolderWatcher(root, engine.enqueue_sync, engine.enqueue_delete, engine.enqueue_move,
+                            lambda: engine.request_rescan(root))
+    watcher.start()
+    try:
+        chosen = paths[-min(count, len(paths)):]
+        ids = {p: engine.db["files"][p]["id"] for p in chosen}
+        backend.reset_stats()
+        removed = {}
+        start = time.perf_counter()
+        for p in chosen:
+            os.remove(p)
+            removed[p] = time.monotonic()
+        done = wait_for(lambda: not any(ids[p] in backend.files for p in chosen), timeout)
+        elapsed = time.perf_counter() - start
+        e2e = [backend.modified_at[ids[p]] - removed[p] for p in chosen if ids[p] not in backend.files]
+        report("mass delete" + ("" if done else " (timeout)"), len(chosen), 0, elapsed, backend, e2e)
+    finally:
+        watcher.stop()
+    del paths[-len(chosen):]
+
+
+def bench_reconcile(client, backend, root, paths, edits):
+    # A restart: a fresh engine loads the tracking store and walks the tree
+    # from its directory snapshots, picking up `edits` files changed while
+    # it was not running.
+    chosen = random.sample(paths, min(edits, len(paths)))
+    for p in chosen:
+        with open(p, "ab") as f:
+            f.write(b"offline")
+    backend.reset_stats()
+    start = time.perf_counter()
+    since = time.monotonic()
+    engine = SyncEngine(client)
+    engine.register_folder(root)
+    engine.sync_folder(root)
+    report("startup reconcile", len(paths), sum(os.path.getsize(p) for p in chosen),
+           time.perf_counter() - start, backend, landed(engine, backend, chosen, since))
+    return engine
+
+
+def run(args, count):
+    print(f"--- {count} files of {args.file_size} bytes, latency {args.latency * 1e3:.0f}ms, "
+          f"errors {args.error_rate:.1%}, quota {args.quota or 'none'}/s, "
+          f"client rate {args.api_rate or API_RATE:g}/s")
+    remove_store(TRACKING_DB)
+    backend = FakeDriveBackend(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                               quota=args.quota, upload_bps=args.upload_mbps * 1e6 / 8, seed=args.seed)
+    with tempfile.TemporaryDirectory(dir=BENCH_HOME) as tmp:
+        root = os.path.join(tmp, "SyncRoot")
+        start = time.perf_counter()
+        paths = make_tree(root, count, args.file_size)
+        print(f"{'tree built':<22} {time.perf_counter() - start:8.2f}s")
+
+        client = make_client(backend, args.api_rate)
+        engine = SyncEngine(client, workers=args.workers)
+        try:
+            if "initial" in args.scenarios:
+                bench_initial(engine, backend, root, paths, args.file_size)
+            if "edits" in args.scenarios:
+                bench_edits(engine, backend, root, paths, min(args.edits, count), args.timeout)
+            if "delete" in args.scenarios:
+                bench_delete(engine, backend, root, paths, min(args.deletes, count), args.timeout)
+            if "reconcile" in args.scenarios:
+                engine.close()
+                engine = bench_reconcile(client, backend, root, paths, min(args.offline_edits, count))
+        finally:
+            engine.close()
+    remove_store(TRACKING_DB)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end DriveSync throughput against an in-process fake Drive.")
+    parser.add_argument("--files", type=int, nargs="+", default=[1000, 10000],
+                        help="tree sizes to run, e.g. 1000 100000 1000000")
+    parser.add_argument("--file-size", type=int, default=4096)
+    parser.add_argument("--scenarios", nargs="+", default=["initial", "edits", "delete", "reconcile"],
+                        choices=["initial", "edits", "delete", "reconcile"])
+    parser.add_argument("--edits", type=int, default=500)
+    parser.add_argument("--deletes", type=int, default=500)
+    parser.add_argument("--offline-edits", type=int, default=100,
+                        help="files changed while the engine is down, before the reconcile scenario")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per HTTP round trip")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of round trips failing with 503")
+    parser.add_argument("--quota", type=int, default=0, help="round trips per second before 403 rate limits")
+    parser.add_argument("--api-rate", type=float, default=None,
+                        help="client-side request rate limit (default DRIVESYNC_API_RATE)")
+    parser.add_argument("--upload-mbps", type=float, default=0, help="simulated uplink, 0 for unlimited")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    for count in args.files:
+        run(args, count)
+
+
+if __name__ == "__main__":
+    main()
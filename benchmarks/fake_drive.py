@@ -0,0 +1,453 @@
+import re
+import time
+import random
+import hashlib
+import itertools
+import threading
+from collections import Counter, defaultdict
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+ROOT_ID = "root"
+
+_TOKEN = re.compile(r"\s*(?:(\()|(\))|('(?:[^'\\]|\\.)*')|(!=|=)|([A-Za-z_][A-Za-z0-9_]*))")
+
+
+def _http_error(status, reason):
+    resp = httplib2.Response({"status": str(status)})
+    resp.reason = reason
+    content = ('{"error": {"code": %d, "message": "%s", "errors": [{"reason": "%s"}]}}'
+               % (status, reason, reason)).encode()
+    return HttpError(resp, content)
+
+
+# files.list query parsing: the subset DriveClient sends (name/mimeType
+# comparisons, 'id' in parents, trashed, combined with and/or/not and
+# parentheses). compile_query returns (predicate, parents): parents is the
+# set of parent ids every match must have one of, or None if unconstrained,
+# so the backend only has to test those parents' children.
+def _tokenize(q):
+    tokens, pos = [], 0
+    q = q.strip()
+    while pos < len(q):
+        m = _TOKEN.match(q, pos)
+        if not m:
+            raise ValueError(f"bad query near {q[pos:]!r}")
+        pos = m.end()
+        lparen, rparen, string, op, word = m.groups()
+        if string:
+            tokens.append(("str", re.sub(r"\\(.)", r"\1", string[1:-1])))
+        elif op:
+            tokens.append(("op", op))
+        elif word:
+            tokens.append(("word", word))
+        else:
+            tokens.append(("paren", lparen or rparen))
+    return tokens
+
+
+def compile_query(q):
+    tokens = _tokenize(q)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else (None, None)
+
+    def take():
+        tok = peek()
+        pos[0] += 1
+        return tok
+
+    def value(tok):
+        kind, v = tok
+        if kind == "str":
+            return v
+        if v in ("true", "false"):
+            return v == "true"
+        raise ValueError(f"bad value {v!r}")
+
+    def term():
+        kind, v = peek()
+        if kind == "paren" and v == "(":
+            take()
+            node = expr()
+            take()
+            return node
+        if kind == "word" and v == "not":
+            take()
+            inner = term()[0]
+            return (lambda f: not inner(f)), None
+        if kind == "str":
+            needle = take()[1]
+            if take() != ("word", "in"):
+                raise ValueError("expected 'in'")
+            field = take()[1]
+            return (lambda f: needle in f.get(field, ())), ({needle} if field == "parents" else None)
+        field = take()[1]
+        op = take()[1]
+        want = value(take())
+        if op == "=":
+            return (lambda f: f.get(field, False) == want), None
+        return (lambda f: f.get(field, False) != want), None
+
+    def conj():
+        nodes = [term()]
+        while peek() == ("word", "and"):
+            take()
+            nodes.append(term())
+        preds = [p for p, _ in nodes]
+        bounded = [s for _, s in nodes if s is not None]
+        return (lambda f: all(p(f) for p in preds)), (min(bounded, key=len) if bounded else None)
+
+    def expr():
+        nodes = [conj()]
+        while peek() == ("word", "or"):
+            take()
+            nodes.append(conj())
+        preds = [p for p, _ in nodes]
+        bounds = [s for _, s in nodes]
+        parents = None if any(s is None for s in bounds) else set().union(*bounds)
+        return (lambda f: any(p(f) for p in preds)), parents
+
+    return expr()
+
+
+class FakeDriveBackend:
+    # In-process stand-in for the parts of Drive v3 that DriveClient uses.
+    # latency/jitter are seconds per HTTP round trip, error_rate injects 503s,
+    # quota caps requests per second (excess gets a 403 userRateLimitExceeded)
+    # and upload_bps caps media throughput per chunk.
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, quota=0, upload_bps=0,
+                 page_size=1000, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota = quota
+        self.upload_bps = upload_bps
+        self.page_size = page_size
+        self.random = random.Random(seed)
+        self.files = {ROOT_ID: {"id": ROOT_ID, "name": "My Drive", "mimeType": FOLDER_MIME,
+                                "parents": [], "trashed": False}}
+        self.children = defaultdict(set)
+        self.changes = []
+        self.sessions = {}
+        self.calls = Counter()
+        self.round_trips = 0
+        self.errors = Counter()
+        self.latencies = []
+        self.modified_at = {}
+        self.bytes_received = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+        self._window = (0, 0)
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls.clear()
+            self.errors.clear()
+            self.round_trips = 0
+            self.latencies = []
+            self.bytes_received = 0
+
+    def service(self):
+        return FakeService(self)
+
+    # Called once per HTTP round trip (a batch is one round trip).
+    def round_trip(self, method, payload=0):
+        with self._lock:
+            self.round_trips += 1
+            self.calls[method] += 1
+            now = int(time.monotonic())
+            second, count = self._window
+            self._window = (now, count + 1) if second == now else (now, 1)
+            over_quota = self.quota and self._window[1] > self.quota
+            failed = not over_quota and self.random.random() < self.error_rate
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if self.upload_bps and payload:
+            delay += payload / self.upload_bps
+        if delay:
+            time.sleep(delay)
+        if over_quota:
+            self.errors["rate_limit"] += 1
+            raise _http_error(403, "userRateLimitExceeded")
+        if failed:
+            self.errors["backend"] += 1
+            raise _http_error(503, "backendError")
+
+    # Latencies are wall time as the client sees a call (injected delay,
+    # backend work and lock contention), recorded by FakeRequest/FakeBatch.
+    def record_latency(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def _new_id(self):
+        return f"fake{next(self._ids)}"
+
+    def _record_change(self, file_id, removed=False):
+        f = self.files.get(file_id)
+        self.changes.append({"fileId": file_id, "removed": removed,
+                             "file": None if removed or f is None else dict(f)})
+
+    def _require(self, file_id):
+        f = self.files.get(file_id)
+        if f is None:
+            raise _http_error(404, "notFound")
+        return f
+
+    # files.*
+
+    def list(self, q=None, pageToken=None, pageSize=None, **_):
+        pred, parents = compile_query(q) if q else ((lambda f: True), None)
+        with self._lock:
+            if parents is None:
+                candidates = self.files.values()
+            else:
+                ids = set().union(*(self.children.get(p, ()) for p in parents))
+                candidates = [self.files[c] for c in sorted(ids)]
+            matches = [dict(f) for f in candidates if f["id"] != ROOT_ID and pred(f)]
+        size = min(pageSize or 100, self.page_size)
+        start = int(pageToken or 0)
+        res = {"files": matches[start:start + size]}
+        if start + size < len(matches):
+            res["nextPageToken"] = str(start + size)
+        return res
+
+    def create(self, body=None, digest=None, size=None, **_):
+        body = body or {}
+        with self._lock:
+            file_id = self._new_id()
+            f = {"id": file_id, "name": body.get("name", "Untitled"),
+                 "mimeType": body.get("mimeType", "application/octet-stream"),
+                 "parents": list(body.get("parents") or [ROOT_ID]), "trashed": False}
+            if digest is not None:
+                f["md5Checksum"] = digest
+                f["size"] = str(size)
+                self.modified_at[file_id] = time.monotonic()
+            self.files[file_id] = f
+            for p in f["parents"]:
+                self.children[p].add(file_id)
+            self._record_change(file_id)
+            return {"id": file_id}
+
+    def update(self, fileId, body=None, addParents=None, removeParents=None,
+               digest=None, size=None, **_):
+        with self._lock:
+            f = self._require(fileId)
+            if body and "name" in body:
+                f["name"] = body["name"]
+            if removeParents:
+                for p in removeParents.split(","):
+                    self.children[p].discard(fileId)
+                f["parents"] = [p for p in f["parents"] if p not in removeParents.split(",")]
+            if addParents:
+                for p in addParents.split(","):
+                    self.children[p].add(fileId)
+                f["parents"].extend(p for p in addParents.split(",") if p not in f["parents"])
+            if digest is not None:
+                f["md5Checksum"] = digest
+                f["size"] = str(size)
+                self.modified_at[fileId] = time.monotonic()
+            self._record_change(fileId)
+            return {"id": fileId}
+
+    def delete(self, fileId, **_):
+        with self._lock:
+            self._require(fileId)
+            doomed, frontier = [fileId], [fileId]
+            while frontier:
+                children = self.children.pop(frontier.pop(), ())
+                doomed.extend(children)
+                frontier.extend(children)
+            for file_id in doomed:
+                f = self.files.pop(file_id, None)
+                for p in f["parents"] if f else ():
+                    self.children.get(p, set()).discard(file_id)
+                self.modified_at[file_id] = time.monotonic()
+                self._record_change(file_id, removed=True)
+        return ""
+
+    def copy(self, fileId, body=None, **_):
+        with self._lock:
+            src = self._require(fileId)
+            body = body or {}
+            return self.create(
+                {"name": body.get("name", src["name"]), "mimeType": src["mimeType"],
+                 "parents": body.get("parents") or src["parents"]},
+                digest=src.get("md5Checksum"), size=src.get("size")
+            )
+
+    # changes.*
+
+    def start_page_token(self):
+        with self._lock:
+            return {"startPageToken": str(len(self.changes))}
+
+    def list_changes(self, pageToken, pageSize=None, **_):
+        with self._lock:
+            start = int(pageToken)
+            end = min(start + (pageSize or 100), len(self.changes))
+            res = {"changes": [dict(c) for c in self.changes[start:end]]}
+            if end < len(self.changes):
+                res["nextPageToken"] = str(end)
+            else:
+                res["newStartPageToken"] = str(end)
+            return res
+
+
+class FakeRequest:
+    def __init__(self, backend, method, fn, kwargs, media=None):
+        self.backend = backend
+        self.method = method
+        self.fn = fn
+        self.kwargs = kwargs
+        self.media = media
+        self.headers = {}
+        self.resumable_uri = None
+        self.resumable_progress = 0
+        self._in_error_state = False
+
+    def _payload(self):
+        return self.media.size() if self.media is not None else 0
+
+    def run(self):
+        if self.media is None:
+            return self.fn(**self.kwargs)
+        size = self.media.size()
+        data = self.media.getbytes(0, size)
+        with self.backend._lock:
+            self.backend.bytes_received += size
+        return self.fn(digest=hashlib.md5(data).hexdigest(), size=size, **self.kwargs)
+
+    def execute(self, http=None, num_retries=0):
+        start = time.perf_counter()
+        try:
+            self.backend.round_trip(self.method, self._payload())
+            return self.run()
+        finally:
+            self.backend.record_latency(time.perf_counter() - start)
+
+    def next_chunk(self, http=None, num_retries=0):
+        start = time.perf_counter()
+        try:
+            return self._next_chunk()
+        finally:
+            self.backend.record_latency(time.perf_counter() - start)
+
+    def _next_chunk(self):
+        backend = self.backend
+        size = self.media.size()
+        chunk = min(self.media.chunksize(), size - self.resumable_progress)
+        backend.round_trip(self.method + ".chunk", chunk)
+        with backend._lock:
+            session = backend.sessions.get(self.resumable_uri)
+            if session is None:
+                self.resumable_uri = f"fake://upload/{len(backend.sessions) + 1}"
+                session = backend.sessions[self.resumable_uri] = {"md5": hashlib.md5(), "offset": 0}
+            if self._in_error_state:
+                # Same as the server's 308: continue from the committed offset.
+                self.resumable_progress = session["offset"]
+                self._in_error_state = False
+                chunk = min(self.media.chunksize(), size - self.resumable_progress)
+        data = self.media.getbytes(self.resumable_progress, chunk)
+        with backend._lock:
+            session["md5"].update(data)
+            session["offset"] += len(data)
+            backend.bytes_received += len(data)
+        self.resumable_progress += len(data)
+        if self.resumable_progress < size:
+            return self.resumable_progress, None
+        with backend._lock:
+            del backend.sessions[self.resumable_uri]
+        return None, self.fn(digest=session["md5"].hexdigest(), size=size, **self.kwargs)
+
+
+class FakeBatch:
+    def __init__(self, backend, callback):
+        self.backend = backend
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request_id or str(len(self.requests)), request))
+
+    def execute(self, http=None):
+        start = time.perf_counter()
+        try:
+            self._execute()
+        finally:
+            self.backend.record_latency(time.perf_counter() - start)
+
+    def _execute(self):
+        self.backend.round_trip("batch")
+        for request_id, request in self.requests:
+            with self.backend._lock:
+                self.backend.calls[request.method] += 1
+            try:
+                response, exception = request.run(), None
+            except HttpError as e:
+                response, exception = None, e
+            self.callback(request_id, response, exception)
+
+
+class _Files:
+    def __init__(self, backend):
+        self.b = backend
+
+    def list(self, **kw):
+        return FakeRequest(self.b, "files.list", self.b.list, kw)
+
+    def create(self, media_body=None, **kw):
+        return FakeRequest(self.b, "files.create", self.b.create, _strip(kw), media_body)
+
+    def update(self, media_body=None, **kw):
+        return FakeRequest(self.b, "files.update", self.b.update, _strip(kw), media_body)
+
+    def delete(self, **kw):
+        return FakeRequest(self.b, "files.delete", self.b.delete, kw)
+
+    def copy(self, **kw):
+        return FakeRequest(self.b, "files.copy", self.b.copy, _strip(kw))
+
+
+class _Changes:
+    def __init__(self, backend):
+        self.b = backend
+
+    def getStartPageToken(self, **kw):
+        return FakeRequest(self.b, "changes.getStartPageToken", self.b.start_page_token, {})
+
+    def list(self, **kw):
+        return FakeRequest(self.b, "changes.list", self.b.list_changes, kw)
+
+
+def _strip(kw):
+    kw.pop("fields", None)
+    return kw
+
+
+class FakeService:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        return _Files(self.backend)
+
+    def changes(self):
+        return _Changes(self.backend)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.backend, callback)
+
+
+class FakeTransport:
+    # Drop-in for core.transport.DriveTransport: DriveClient(...).transport =
+    # FakeTransport(backend) routes every call into the backend.
+    def __init__(self, backend):
+        self.backend = backend
+        self.services_built = 0
+
+    @property
+    def service(self):
+        return FakeService(self.backend)
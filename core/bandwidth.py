@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+
+from core import metrics
+
+# Limits are in KiB/s; 0 means unlimited.
+UPLOAD_LIMIT_KIB = int(os.environ.get("DRIVESYNC_UPLOAD_KIBPS", "0"))
+# e.g. "08:00-18:00=512,18:00-08:00=0": throttle business hours, open up at night.
+UPLOAD_SCHEDULE = os.environ.get("DRIVESYNC_UPLOAD_SCHEDULE", "")
+CHUNK_ALIGN = 256 * 1024
+BURST_SECONDS = 1.0
+
+UPLOAD_BYTES = metrics.counter("drivesync_upload_bytes_total", "Bytes uploaded to Drive")
+UPLOAD_THROTTLED = metrics.counter("drivesync_upload_throttled_seconds_total", "Time uploads slept on the bandwidth limit")
+UPLOAD_RATE_LIMIT = metrics.gauge("drivesync_upload_rate_limit_bytes", "Current upload limit, 0 if unlimited")
+
+
+def _minutes(hhmm):
+    h, m = hhmm.strip().split(":")
+    return int(h) * 60 + int(m)
+
+
+def parse_schedule(text):
+    windows = []
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        try:
+            span, rate = part.split("=")
+            start, end = span.split("-")
+            windows.append((_minutes(start), _minutes(end), int(rate) * 1024))
+        except ValueError:
+            print("[BANDWIDTH ERROR] bad schedule entry:", part)
+    return windows
+
+
+class BandwidthLimiter:
+    # Byte token bucket shared by every upload worker. Uploads draw on it
+    # one chunk at a time; a chunk larger than the bucket is let through and
+    # paid back as debt, so the long-run rate holds at any chunk size.
+    def __init__(self, rate=UPLOAD_LIMIT_KIB * 1024, schedule=UPLOAD_SCHEDULE):
+        self._lock = threading.Lock()
+        self.base_rate = rate
+        self.windows = parse_schedule(schedule) if isinstance(schedule, str) else list(schedule or [])
+        self.bytes_sent = 0
+        UPLOAD_RATE_LIMIT.set_function(self.current_rate)
+        self._tokens = 0
+        self._stamp = time.monotonic()
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.base_rate = max(0, int(rate))
+
+    def set_schedule(self, schedule):
+        windows = parse_schedule(schedule) if isinstance(schedule, str) else list(schedule)
+        with self._lock:
+            self.windows = windows
+
+    def current_rate(self, now=None):
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end, rate in self.windows:
+            inside = start <= minute < end if start <= end else (minute >= start or minute < end)
+            if inside:
+                return rate
+        return self.base_rate
+
+    def chunk_cap(self, chunk):
+        # Keeps chunks to about a second of the current rate, so throttling stays
+        # smooth instead of one burst followed by a long pause.
+        rate = self.current_rate()
+        if not rate:
+            return chunk
+        return min(chunk, max(CHUNK_ALIGN, int(rate * BURST_SECONDS) // CHUNK_ALIGN * CHUNK_ALIGN))
+
+    def record(self, n):
+        with self._lock:
+            self.bytes_sent += n
+        UPLOAD_BYTES.inc(n)
+
+    def consume(self, n):
+        while True:
+            rate = self.current_rate()
+            with self._lock:
+                now = time.monotonic()
+                if not rate:
+                    self._tokens = 0
+                    self._stamp = now
+                    return
+                self._tokens = min(rate * BURST_SECONDS, self._tokens + (now - self._stamp) * rate)
+                self._stamp = now
+                if self._tokens > 0:
+                    self._tokens -= n
+                    return
+                wait = -self._tokens / rate
+            # Sleep in slices so a rate change or schedule switch applies promptly.
+            time.sleep(min(wait, 1.0) + 0.001)
+            UPLOAD_THROTTLED.inc(min(wait, 1.0) + 0.001)
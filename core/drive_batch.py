@@ -0,0 +1,116 @@
+import time
+import threading
+from concurrent.futures import Future
+
+from core.rate_limit import is_retryable
+from core import metrics
+from core.metrics import API_CALLS, API_ERRORS, API_SECONDS, QUEUE_DEPTH
+
+BATCH_LIMIT = 100
+BATCH_LINGER = 0.05
+BATCH_RETRIES = 4
+
+BATCH_SIZE = metrics.histogram("drivesync_batch_size", "Requests per Drive batch call", buckets=(1, 5, 10, 25, 50, 100))
+
+
+class _Op:
+    __slots__ = ("build", "future", "attempts", "not_before")
+
+    def __init__(self, build):
+        self.build = build
+        self.future = Future()
+        self.attempts = 0
+        self.not_before = 0
+
+
+class BatchQueue:
+    # Groups queued metadata requests into Drive batch calls (up to
+    # BATCH_LIMIT per call). Each submit() gets its own Future, resolved from
+    # its sub-response; retryable per-item failures are re-queued with backoff.
+    def __init__(self, client, limit=BATCH_LIMIT, linger=BATCH_LINGER):
+        self.client = client
+        self.limit = limit
+        self.linger = linger
+        self._ops = []
+        self._cond = threading.Condition()
+        QUEUE_DEPTH.set_function(lambda: len(self._ops), stage="batch")
+        self._thread = threading.Thread(target=self._run, name="drive-batch", daemon=True)
+        self._thread.start()
+
+    def submit(self, build):
+        op = _Op(build)
+        with self._cond:
+            self._ops.append(op)
+            self._cond.notify()
+        return op.future
+
+    def _take(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready = [op for op in self._ops if op.not_before <= now]
+                if len(ready) >= self.limit:
+                    break
+                if ready:
+                    # Give concurrent callers a moment to join this batch.
+                    self._cond.wait(self.linger)
+                    now = time.monotonic()
+                    ready = [op for op in self._ops if op.not_before <= now]
+                    break
+                if self._ops:
+                    self._cond.wait(max(0.01, min(op.not_before for op in self._ops) - now))
+                else:
+                    self._cond.wait()
+            ready = ready[:self.limit]
+            taken = set(map(id, ready))
+            self._ops = [op for op in self._ops if id(op) not in taken]
+            return ready
+
+    def _run(self):
+        while True:
+            ops = self._take()
+            if ops:
+                self._execute(ops)
+
+    def _execute(self, ops):
+        results = {}
+
+        def on_response(request_id, response, exception):
+            results[request_id] = (response, exception)
+
+        try:
+            # Each sub-request counts against the per-user quota.
+            self.client.limiter.bucket.acquire(len(ops))
+            service = self.client.service
+            batch = service.new_batch_http_request(callback=on_response)
+            methods = []
+            for i, op in enumerate(ops):
+                request = op.build(service)
+                methods.append(getattr(request, "methodId", None) or "unknown")
+                batch.add(request, request_id=str(i))
+            for method in methods:
+                API_CALLS.inc(method=method)
+            API_CALLS.inc(method="batch")
+            BATCH_SIZE.observe(len(ops))
+            with API_SECONDS.time(method="batch"):
+                batch.execute()
+        except Exception as e:
+            API_ERRORS.inc(method="batch")
+            for i in range(len(ops)):
+                results.setdefault(str(i), (None, e))
+
+        retry = []
+        for i, op in enumerate(ops):
+            response, exception = results.get(str(i), (None, None))
+            if exception is None:
+                op.future.set_result(response)
+            elif is_retryable(exception) and op.attempts < BATCH_RETRIES:
+                op.not_before = time.monotonic() + self.client.limiter.note_failure(exception, op.attempts)
+                op.attempts += 1
+                retry.append(op)
+            else:
+                op.future.set_exception(exception)
+        if retry:
+            with self._cond:
+                self._ops.extend(retry)
+                self._cond.notify()
@@ -1,30 +1,165 @@
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
 from googleapiclient.errors import HttpError
 import os
+import threading
 import traceback
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from core.drive_batch import BatchQueue
+from core.hasher import Hasher
+from core.rate_limit import RateLimiter, DriveError, is_retryable
+from core.bandwidth import BandwidthLimiter
+from core.transport import DriveTransport
+from core.metrics import API_CALLS, API_ERRORS, API_SECONDS
+
+FOLDER_MIME = "application/vnd.google-apps.folder"
+PAGE_SIZE = 1000
+PARENTS_PER_QUERY = 40
+MULTIPART_LIMIT = 5 * 1024 * 1024
+CHUNK_SIZES = (
+    (1024 * 1024 * 1024, 64 * 1024 * 1024),
+    (100 * 1024 * 1024, 16 * 1024 * 1024),
+    (0, 8 * 1024 * 1024),
+)
+
+
+DOWNLOAD_CHUNK = 16 * 1024 * 1024
+RANGE_DOWNLOAD_MIN = 64 * 1024 * 1024
+RANGE_SIZE = 32 * 1024 * 1024
+RANGE_WORKERS = 4
+
+def timed_call(fn, method):
+    API_CALLS.inc(method=method)
+    start = time.perf_counter()
+    try:
+        return fn()
+    except Exception:
+        API_ERRORS.inc(method=method)
+        raise
+    finally:
+        API_SECONDS.observe(time.perf_counter() - start, method=method)
+
+
+def upload_chunk_size(size):
+    for threshold, chunk in CHUNK_SIZES:
+        if size >= threshold:
+            return chunk
 
 
 class DriveClient:
     def __init__(self, creds):
-        self.service = build("drive", "v3", credentials=creds)
+        self.creds = creds
+        self.transport = DriveTransport(creds)
+        self._cache_lock = threading.Lock()
+        self._children = {}
+        self._keys = {}
+        self._listed = set()
+        self.limiter = RateLimiter()
+        self.bandwidth = BandwidthLimiter()
+        self.batch = BatchQueue(self)
+        self._range_pool = None
+
+    @property
+    def service(self):
+        return self.transport.service
+
+    def _execute(self, request):
+        return self.limiter.call(timed_call, request.execute, getattr(request, "methodId", None) or "unknown")
+
+    def _remember(self, kind, parent_id, name, file_id):
+        with self._cache_lock:
+            key = (kind, parent_id, name)
+            if key in self._children:
+                return
+            self._children[key] = file_id
+            self._keys[file_id] = key
+
+    def _forget(self, file_id):
+        with self._cache_lock:
+            key = self._keys.pop(file_id, None)
+            if key is not None and self._children.get(key) == file_id:
+                del self._children[key]
+
+    def _cached(self, kind, parent_id, name):
+        # Returns (id, known): known is True when the parent was fully listed,
+        # so a miss means the child does not exist and no query is needed.
+        with self._cache_lock:
+            file_id = self._children.get((kind, parent_id, name))
+            return file_id, file_id is not None or parent_id in self._listed
+
+    def walk_tree(self, root_id):
+        # Yields (parent_id, file) for every item below root_id, breadth-first,
+        # filling the (parent, name) -> id cache along the way.
+        frontier = [root_id]
+        while frontier:
+            next_frontier = []
+            for i in range(0, len(frontier), PARENTS_PER_QUERY):
+                chunk = frontier[i:i + PARENTS_PER_QUERY]
+                wanted = set(chunk)
+                parents = " or ".join(f"'{p}' in parents" for p in chunk)
+                token = None
+                while True:
+                    res = self._execute(self.service.files().list(
+                        q=f"({parents}) and trashed=false",
+                        spaces="drive",
+                        fields="nextPageToken, files(id, name, mimeType, parents, size, md5Checksum)",
+                        pageSize=PAGE_SIZE,
+                        pageToken=token
+                    ))
+                    for f in res.get("files", []):
+                        is_folder = f.get("mimeType") == FOLDER_MIME
+                        for parent in f.get("parents", []):
+                            if parent in wanted:
+                                self._remember("folder" if is_folder else "file", parent, f["name"], f["id"])
+                                yield parent, f
+                        if is_folder:
+                            next_frontier.append(f["id"])
+                    token = res.get("nextPageToken")
+                    if not token:
+                        break
+                with self._cache_lock:
+                    self._listed.update(chunk)
+            frontier = next_frontier
+
+    def prefetch_tree(self, root_id):
+        # A root this client already walked is kept current by _remember
+        # for everything it creates since.
+        with self._cache_lock:
+            if root_id in self._listed:
+                return
+        try:
+            for _ in self.walk_tree(root_id):
+                pass
+        except HttpError as e:
+            print("[DRIVE PREFETCH ERROR]", e)
+            traceback.print_exc()
+
     def create_or_get_folder(self, name, parent_id=None):
         try:
-            if parent_id:
-                query = (
-                    f"name='{name}' and mimeType='application/vnd.google-apps.folder' "
-                    f"and '{parent_id}' in parents and trashed=false"
-                )
-            else:
-                query = (
-                    f"name='{name}' and mimeType='application/vnd.google-apps.folder' "
-                    "and trashed=false"
-                )
+            cached, known = self._cached("folder", parent_id, name) if parent_id else (None, False)
+            if cached:
+                return cached
+
+            if not known:
+                if parent_id:
+                    query = (
+                        f"name='{name}' and mimeType='application/vnd.google-apps.folder' "
+                        f"and '{parent_id}' in parents and trashed=false"
+                    )
+                else:
+                    query = (
+                        f"name='{name}' and mimeType='application/vnd.google-apps.folder' "
+                        "and trashed=false"
+                    )
 
-            res = self.service.files().list(q=query, spaces="drive").execute()
+                res = self._execute(self.service.files().list(q=query, spaces="drive"))
 
-            if res["files"]:
-                return res["files"][0]["id"]
+                if res["files"]:
+                    if parent_id:
+                        self._remember("folder", parent_id, name, res["files"][0]["id"])
+                    return res["files"][0]["id"]
 
             metadata = {
                 "name": name,
@@ -34,67 +169,309 @@ class DriveClient:
             if parent_id:
                 metadata["parents"] = [parent_id]
 
-            folder = self.service.files().create(body=metadata, fields="id").execute()
+            folder = self._execute(self.service.files().create(body=metadata, fields="id"))
+            if parent_id:
+                self._remember("folder", parent_id, name, folder["id"])
+            with self._cache_lock:
+                self._listed.add(folder["id"])
             return folder["id"]
 
         except HttpError as e:
             print("[DRIVE FOLDER ERROR]", e)
-            traceback.print_exc()
+            raise DriveError(str(e), retryable=is_retryable(e), cause=e)
+
+    def get_start_page_token(self):
+        try:
+            return self._execute(self.service.changes().getStartPageToken())["startPageToken"]
+        except HttpError as e:
+            print("[CHANGES ERROR]", e)
+            return None
+
+    def list_changes(self, page_token):
+        changes = []
+        try:
+            while True:
+                res = self._execute(self.service.changes().list(
+                    pageToken=page_token,
+                    spaces="drive",
+                    pageSize=PAGE_SIZE,
+                    fields="nextPageToken, newStartPageToken, "
+                           "changes(fileId, removed, file(name, parents, md5Checksum, trashed, mimeType))"
+                ))
+                changes.extend(res.get("changes", []))
+                if "newStartPageToken" in res:
+                    return changes, res["newStartPageToken"]
+                page_token = res["nextPageToken"]
+        except HttpError as e:
+            print("[CHANGES ERROR]", e)
             return None
 
-    def upload_or_update(self, path, parent_id):
+    def _media(self, path):
+        size = os.path.getsize(path)
+        if size <= MULTIPART_LIMIT:
+            return MediaFileUpload(path, resumable=False)
+        return MediaFileUpload(path, resumable=True, chunksize=self.bandwidth.chunk_cap(upload_chunk_size(size)))
+
+    def _send(self, build, session=None, on_session=None):
+        request, media = build()
+        if not media.resumable():
+            self.bandwidth.consume(media.size())
+            response = self._execute(request)
+            self.bandwidth.record(media.size())
+            return response
+        if session:
+            # Resume a persisted session; the error-state flag makes the client
+            # ask the server for the committed offset before sending more bytes.
+            request.resumable_uri = session["uri"]
+            request.resumable_progress = session.get("offset", 0)
+            request._in_error_state = True
+        response = None
+        try:
+            while response is None:
+                before = request.resumable_progress
+                self.bandwidth.consume(min(media.chunksize(), media.size() - before))
+                _, response = self.limiter.call(timed_call, request.next_chunk, "upload.chunk")
+                self.bandwidth.record((media.size() if response is not None else request.resumable_progress) - before)
+                if response is None and on_session:
+                    on_session(request.resumable_uri, request.resumable_progress)
+        except HttpError as e:
+            if session and e.resp.status in (404, 410):
+                return self._send(build, None, on_session)
+            raise
+        return response
+
+    def _update_media(self, file_id, path, session=None, on_session=None):
+        def build():
+            media = self._media(path)
+            return self.service.files().update(fileId=file_id, media_body=media), media
+        self._send(build, session, on_session)
+        return file_id
+
+    def upload_or_update(self, path, parent_id, file_id=None, session=None, on_session=None):
         try:
             name = os.path.basename(path)
 
-            query = (
-                f"name='{name}' and '{parent_id}' in parents and trashed=false"
-            )
-            existing = self.service.files().list(q=query, spaces="drive").execute().get("files", [])
+            # Known or cached IDs go straight to files.update; only a 404 sends us back to a lookup.
+            if not file_id:
+                file_id, known = self._cached("file", parent_id, name)
+            else:
+                known = False
+            if file_id:
+                try:
+                    return self._update_media(file_id, path, session, on_session)
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    self._forget(file_id)
+                    known = False
+                    session = None
 
-            media = MediaFileUpload(path, resumable=True)
+            if known:
+                existing = []
+            else:
+                query = (
+                    f"name='{name}' and '{parent_id}' in parents and trashed=false"
+                )
+                existing = self._execute(self.service.files().list(q=query, spaces="drive")).get("files", [])
 
-        
             if existing:
-                file_id = existing[0]["id"]
-                self.service.files().update(
-                    fileId=file_id,
-                    media_body=media
-                ).execute()
-                return file_id
-
-        
+                self._remember("file", parent_id, name, existing[0]["id"])
+                return self._update_media(existing[0]["id"], path, session, on_session)
+
             metadata = {
                 "name": name,
                 "parents": [parent_id]
             }
 
-            upload = self.service.files().create(
-                body=metadata,
-                media_body=media,
-                fields="id"
-            ).execute()
+            def build():
+                media = self._media(path)
+                return self.service.files().create(body=metadata, media_body=media, fields="id"), media
+            upload = self._send(build, session, on_session)
 
+            self._remember("file", parent_id, name, upload["id"])
             return upload["id"]
 
-        except HttpError as e:
+        except (HttpError, OSError) as e:
             print("[UPLOAD ERROR]", e)
-            traceback.print_exc()
-            return None
-
+            raise DriveError(str(e), retryable=is_retryable(e), cause=e)
 
-    def delete_file(self, file_id):
+    def copy_file(self, file_id, name, parent_id):
+        # A file already under that name is left to the upload path to update.
+        cached, known = self._cached("file", parent_id, name)
+        if cached:
+            return None
         try:
-            self.service.files().delete(fileId=file_id).execute()
+            if not known:
+                query = f"name='{name}' and '{parent_id}' in parents and trashed=false"
+                existing = self._execute(self.service.files().list(q=query, spaces="drive")).get("files", [])
+                if existing:
+                    self._remember("file", parent_id, name, existing[0]["id"])
+                    return None
+            copy = self._execute(self.service.files().copy(
+                fileId=file_id,
+                body={"name": name, "parents": [parent_id]},
+                fields="id"
+            ))
+            self._remember("file", parent_id, name, copy["id"])
+            return copy["id"]
         except HttpError as e:
-            print("[DELETE ERROR]", e)
-            traceback.print_exc()
+            print("[COPY ERROR]", e)
+            return None
+
+    def _download_ranges(self, file_id, path, size):
+        if self._range_pool is None:
+            self._range_pool = ThreadPoolExecutor(max_workers=RANGE_WORKERS, thread_name_prefix="range")
+
+        def fetch(start):
+            end = min(start + RANGE_SIZE, size) - 1
+            request = self.service.files().get_media(fileId=file_id)
+            request.headers["Range"] = f"bytes={start}-{end}"
+            data = self._execute(request)
+            with open(path, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+
+        with open(path, "wb") as f:
+            f.truncate(size)
+        for fut in [self._range_pool.submit(fetch, start) for start in range(0, size, RANGE_SIZE)]:
+            fut.result()
 
-    def rename_file(self, file_id, new_name):
+    def download_file(self, file_id, dest, size=None, md5=None, before_replace=None):
+        # Streams into a temp file beside dest, checks md5Checksum, then renames
+        # into place, so a partial or corrupt download never replaces a file.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dest), prefix=".drivesync-", suffix=".part")
+        os.close(fd)
         try:
-            self.service.files().update(
-                fileId=file_id,
-                body={"name": new_name}
-            ).execute()
+            size = int(size) if size is not None else None
+            if size and size >= RANGE_DOWNLOAD_MIN:
+                self._download_ranges(file_id, tmp, size)
+            else:
+                with open(tmp, "wb") as f:
+                    downloader = MediaIoBaseDownload(
+                        f, self.service.files().get_media(fileId=file_id), chunksize=DOWNLOAD_CHUNK
+                    )
+                    done = False
+                    while not done:
+                        _, done = self.limiter.call(timed_call, downloader.next_chunk, "download.chunk")
+            if md5 and Hasher("md5").hash_file(tmp) != md5:
+                print("[DOWNLOAD ERROR]", dest, "md5 mismatch")
+                return False
+            if before_replace:
+                before_replace(tmp)
+            os.replace(tmp, dest)
+            return True
         except HttpError as e:
-            print("[RENAME ERROR]", e)
-            traceback.print_exc()
+            print("[DOWNLOAD ERROR]", e)
+            return False
+        finally:
+            if os.path.exists(tmp):
+                try:
+                    os.remove(tmp)
+                except:
+                    pass
+
+    # Returns one entry per item: the folder ID, or the DriveError for an
+    # item that failed, so one bad folder does not sink the rest.
+    def create_folders(self, items):
+        results = [None] * len(items)
+        lookups = {}
+        creates = []
+        for i, (name, parent_id) in enumerate(items):
+            cached, known = self._cached("folder", parent_id, name)
+            if cached:
+                results[i] = cached
+            elif known:
+                creates.append(i)
+            else:
+                query = (
+                    f"name='{name}' and mimeType='application/vnd.google-apps.folder' "
+                    f"and '{parent_id}' in parents and trashed=false"
+                )
+                lookups[i] = self.batch.submit(
+                    lambda svc, q=query: svc.files().list(q=q, spaces="drive", fields="files(id)")
+                )
+
+        for i, fut in lookups.items():
+            try:
+                found = fut.result().get("files", [])
+            except HttpError as e:
+                print("[DRIVE FOLDER ERROR]", e)
+                results[i] = DriveError(str(e), retryable=is_retryable(e), cause=e)
+                continue
+            if found:
+                name, parent_id = items[i]
+                self._remember("folder", parent_id, name, found[0]["id"])
+                results[i] = found[0]["id"]
+            else:
+                creates.append(i)
+
+        pending = {}
+        for i in creates:
+            name, parent_id = items[i]
+            metadata = {"name": name, "mimeType": FOLDER_MIME, "parents": [parent_id]}
+            pending[i] = self.batch.submit(
+                lambda svc, m=metadata: svc.files().create(body=m, fields="id")
+            )
+        for i, fut in pending.items():
+            try:
+                folder_id = fut.result()["id"]
+            except HttpError as e:
+                print("[DRIVE FOLDER ERROR]", e)
+                results[i] = DriveError(str(e), retryable=is_retryable(e), cause=e)
+                continue
+            name, parent_id = items[i]
+            self._remember("folder", parent_id, name, folder_id)
+            with self._cache_lock:
+                self._listed.add(folder_id)
+            results[i] = folder_id
+        return results
+
+    def _finish(self, fut, label, file_id):
+        def done(f):
+            e = f.exception()
+            if e is None:
+                self._forget(file_id)
+            else:
+                print(label, e)
+        fut.add_done_callback(done)
+        return fut
+
+    def delete_file(self, file_id, wait=True):
+        fut = self._finish(
+            self.batch.submit(lambda svc: svc.files().delete(fileId=file_id)),
+            "[DELETE ERROR]", file_id
+        )
+        if wait:
+            try:
+                fut.result()
+            except Exception:
+                pass
+        return fut
+
+    def move_file(self, file_id, new_name, add_parent=None, remove_parent=None, wait=True):
+        def build(svc):
+            kwargs = {"fileId": file_id, "body": {"name": new_name}}
+            if add_parent and remove_parent and add_parent != remove_parent:
+                kwargs["addParents"] = add_parent
+                kwargs["removeParents"] = remove_parent
+            return svc.files().update(**kwargs)
+
+        fut = self._finish(self.batch.submit(build), "[MOVE ERROR]", file_id)
+        if wait:
+            try:
+                fut.result()
+            except Exception:
+                pass
+        return fut
+
+    def rename_file(self, file_id, new_name, wait=True):
+        fut = self._finish(
+            self.batch.submit(lambda svc: svc.files().update(fileId=file_id, body={"name": new_name})),
+            "[RENAME ERROR]", file_id
+        )
+        if wait:
+            try:
+                fut.result()
+            except Exception:
+                pass
+        return fut
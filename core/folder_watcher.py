@@ -1,70 +1,414 @@
+import os
 import time
+import queue
 import threading
+from collections import OrderedDict
+from itertools import islice
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from core import metrics
+from core.metrics import QUEUE_DEPTH
+
+EVENT_QUEUE_SIZE = 50000
+QUIET_PERIOD = 0.5
+MAX_PENDING_PATHS = 50000
+
+WATCHER_EVENTS = metrics.counter("drivesync_watcher_events_total", "Coalesced watcher events by outcome", ("outcome",))
+
+
+class _Pending:
+    __slots__ = ("op", "origin", "dirty", "deadline")
+
+    def __init__(self, op, origin=None, dirty=False):
+        self.op = op
+        self.origin = origin
+        self.dirty = dirty
+        self.deadline = 0
+
+
+class EventCoalescer:
+    # Folds the create/modify/delete/move events seen for a path into one net
+    # operation and emits it once the path has been quiet for QUIET_PERIOD.
+    # Pending paths are bounded: past max_pending the oldest is emitted early.
+    def __init__(self, emit, quiet=QUIET_PERIOD, max_pending=MAX_PENDING_PATHS):
+        self.emit = emit
+        self.quiet = quiet
+        self.max_pending = max_pending
+        self.evicted = 0
+        self._pending = OrderedDict()
+        self._origins = {}
+        self._lock = threading.Lock()
+
+    def pending_sample(self, limit):
+        with self._lock:
+            return len(self._pending), list(islice(self._pending.items(), limit))
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _touch(self, path, entry, out):
+        entry.deadline = time.monotonic() + self.quiet
+        self._pending[path] = entry
+        self._pending.move_to_end(path)
+        if entry.op == "move":
+            self._origins[entry.origin] = path
+        while len(self._pending) > self.max_pending:
+            old_path, old = self._pending.popitem(last=False)
+            self._release(old_path, old, out)
+            self.evicted += 1
+            WATCHER_EVENTS.inc(outcome="evicted")
+
+    def _release(self, path, entry, out):
+        if entry.op == "move":
+            self._origins.pop(entry.origin, None)
+            if entry.origin != path:
+                out.append(("move", entry.origin, path))
+            if entry.dirty or entry.origin == path:
+                out.append(("modify", path, None))
+        elif entry.op == "delete":
+            out.append(("delete", path, None))
+        else:
+            out.append(("modify", path, None))
+
+    def _take(self, path, out):
+        # A pending move out of `path` must land before anything new at `path`.
+        if path in self._origins:
+            dest = self._origins.pop(path)
+            entry = self._pending.pop(dest, None)
+            if entry is not None:
+                self._release(dest, entry, out)
+        return self._pending.pop(path, None)
+
+    def _replace_moved(self, path):
+        # `path` was renamed away moments ago and something new now takes its
+        # place (an atomic save): the Drive file stays at `path` and the
+        # renamed copy becomes a new file.
+        entry = self._pending.get(self._origins.get(path))
+        if entry is None or entry.op != "move":
+            return False
+        del self._origins[path]
+        entry.op, entry.origin = "create", None
+        return True
+
+    def add(self, op, path):
+        out = []
+        with self._lock:
+            if op != "delete":
+                self._replace_moved(path)
+            prev = self._take(path, out)
+            if prev is None:
+                entry = _Pending(op)
+            elif prev.op == "move":
+                if op == "delete":
+                    self._release(path, prev, out)
+                    entry = _Pending("delete")
+                else:
+                    prev.dirty = True
+                    entry = prev
+            elif op == "delete":
+                entry = _Pending("delete")
+            elif prev.op == "create":
+                entry = prev
+            else:
+                entry = _Pending("modify")
+            self._touch(path, entry, out)
+        self._flush_out(out)
+
+    def add_move(self, src, dest):
+        out = []
+        with self._lock:
+            prev_src = self._take(src, out)
+            replaced = self._replace_moved(dest)
+            prev_dest = self._take(dest, out)
+            if prev_dest is not None and prev_dest.op == "delete":
+                replaced = True
+            elif prev_dest is not None and prev_dest.op == "move":
+                self._release(dest, prev_dest, out)
+            if replaced:
+                # dest's own file went away moments ago and src takes its
+                # place: dest is only modified, keeping its Drive file, and
+                # whatever src used to be is deleted.
+                if prev_src is None or prev_src.op in ("modify", "delete"):
+                    out.append(("delete", src, None))
+                elif prev_src.op == "move":
+                    out.append(("delete", prev_src.origin, None))
+                entry = _Pending("modify")
+            elif prev_src is None:
+                entry = _Pending("move", src)
+            elif prev_src.op == "move":
+                entry = _Pending("move", prev_src.origin, prev_src.dirty)
+            elif prev_src.op == "modify":
+                entry = _Pending("move", src, dirty=True)
+            elif prev_src.op == "delete":
+                self._release(src, prev_src, out)
+                entry = _Pending("modify")
+            else:
+                entry = _Pending("modify")
+            self._touch(dest, entry, out)
+        self._flush_out(out)
+
+    def add_dir_move(self, src, dest):
+        # The directory move is emitted at once; anything still pending inside
+        # it follows it to the new path and is emitted afterwards.
+        out = [("move", src, dest)]
+        prefix = src + os.sep
+
+        def rebase(p):
+            return dest + p[len(src):] if p.startswith(prefix) else p
+
+        with self._lock:
+            inside = [(p, e) for p, e in self._pending.items() if p.startswith(prefix)]
+            for p, e in inside:
+                del self._pending[p]
+                if e.op == "move":
+                    self._origins.pop(e.origin, None)
+            for origin in [o for o in self._origins if o.startswith(prefix)]:
+                path = self._origins.pop(origin)
+                self._pending[path].origin = rebase(origin)
+                self._origins[rebase(origin)] = path
+            for p, e in inside:
+                if e.op == "move":
+                    e.origin = rebase(e.origin)
+                self._touch(rebase(p), e, out)
+        self._flush_out(out)
+
+    def flush_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        out = []
+        with self._lock:
+            while self._pending:
+                path, entry = next(iter(self._pending.items()))
+                if entry.deadline > now:
+                    break
+                del self._pending[path]
+                self._release(path, entry, out)
+        self._flush_out(out)
+
+    def flush_all(self):
+        self.flush_due(float("inf"))
+
+    def _flush_out(self, out):
+        for record in out:
+            self.emit(record)
+
 
 class FolderHandler(FileSystemEventHandler):
-    def __init__(self, modify_cb, delete_cb, move_cb):
+    def __init__(self, modify_cb, delete_cb, move_cb, overflow_cb=None, manager=None):
         self.modify_cb = modify_cb
         self.delete_cb = delete_cb
         self.move_cb = move_cb
-        self.last_event = {}
+        self.overflow_cb = overflow_cb
+        self.manager = manager or shared_manager()
         self.lock = threading.Lock()
-        self.DEBOUNCE_MS = 0.25
+        self.coalescer = EventCoalescer(self._enqueue)
+        self.active = True
+
+        self.queued = 0
+        self.enqueued = 0
+        self.dropped = 0
+        self.overflows = 0
+        self._overflowed = False
 
-    def _should_process(self, path):
-        now = time.time()
+    def _enqueue(self, record):
         with self.lock:
-            last = self.last_event.get(path, 0)
-            if now - last < self.DEBOUNCE_MS:
-                return False
-            self.last_event[path] = now
-            return True
+            if self.manager.put(self, record):
+                self.queued += 1
+                self.enqueued += 1
+                WATCHER_EVENTS.inc(outcome="enqueued")
+                return
+            self.dropped += 1
+            WATCHER_EVENTS.inc(outcome="dropped")
+            if not self._overflowed:
+                self._overflowed = True
+                self.overflows += 1
+                WATCHER_EVENTS.inc(outcome="overflow")
 
     def on_created(self, event):
         if event.is_directory:
             return
-        if self._should_process(event.src_path):
-            self.modify_cb(event.src_path)
+        self.coalescer.add("create", event.src_path)
 
     def on_modified(self, event):
         if event.is_directory:
             return
-        if self._should_process(event.src_path):
-            self.modify_cb(event.src_path)
+        self.coalescer.add("modify", event.src_path)
 
     def on_deleted(self, event):
-        if event.is_directory:
-            return
-        self.delete_cb(event.src_path)
+        # A deleted directory is forwarded too, so the engine can forget its
+        # folder and anything under it that did not get its own event.
+        self.coalescer.add("delete", event.src_path)
 
     def on_moved(self, event):
+        if getattr(event, "is_synthetic", False):
+            # Generated for the contents of a moved directory, which the
+            # directory's own move already covers.
+            return
         if event.is_directory:
+            self.coalescer.add_dir_move(event.src_path, event.dest_path)
+            return
+        self.coalescer.add_move(event.src_path, event.dest_path)
+
+    def handle(self, record):
+        with self.lock:
+            self.queued -= 1
+        if not self.active:
             return
-        self.move_cb(event.src_path, event.dest_path)
+        kind, src, dest = record
+        try:
+            if kind == "modify":
+                self.modify_cb(src)
+            elif kind == "delete":
+                self.delete_cb(src)
+            elif kind == "move":
+                self.move_cb(src, dest)
+        except Exception as e:
+            print("[WATCHER ERROR]", e)
+
+    def maybe_recover(self):
+        # Events were dropped while the queue was full; only a rescan can recover them.
+        with self.lock:
+            if not self._overflowed or not self.active:
+                return
+            self._overflowed = False
+        if self.overflow_cb:
+            try:
+                self.overflow_cb()
+            except Exception as e:
+                print("[WATCHER ERROR]", e)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queued,
+            "coalescing": len(self.coalescer),
+            "evicted": self.coalescer.evicted,
+            "enqueued": self.enqueued,
+            "dropped": self.dropped,
+            "overflows": self.overflows,
+        }
+
+
+class WatcherManager:
+    # One observer, one dispatcher and one coalescing ticker for every synced
+    # root; roots are scheduled and unscheduled without touching the others.
+    def __init__(self, max_queue=EVENT_QUEUE_SIZE):
+        self.observer = Observer()
+        self.events = queue.Queue(maxsize=max_queue)
+        self._handlers = {}
+        self._lock = threading.Lock()
+        self._running = False
+        QUEUE_DEPTH.set_function(self.events.qsize, stage="watcher")
+        QUEUE_DEPTH.set_function(lambda: sum(len(h.coalescer) for h in self.handlers()), stage="coalescing")
+
+    def _ensure_started(self):
+        if self._running:
+            return
+        self._running = True
+        self.observer.start()
+        threading.Thread(target=self._dispatch_loop, name="watch-dispatch", daemon=True).start()
+        threading.Thread(target=self._tick_loop, name="watch-coalesce", daemon=True).start()
+
+    def add(self, folder, handler):
+        with self._lock:
+            self._ensure_started()
+            watch = self.observer.schedule(handler, folder, recursive=True)
+            self._handlers[handler] = watch
+        return watch
+
+    def remove(self, handler):
+        with self._lock:
+            watch = self._handlers.pop(handler, None)
+            handler.active = False
+            if watch is not None:
+                try:
+                    self.observer.unschedule(watch)
+                except Exception as e:
+                    print("[WATCHER ERROR]", e)
+
+    def put(self, handler, record):
+        try:
+            self.events.put_nowait((handler, record))
+            return True
+        except queue.Full:
+            return False
+
+    def handlers(self):
+        with self._lock:
+            return list(self._handlers)
+
+    def _tick_loop(self):
+        while self._running:
+            time.sleep(QUIET_PERIOD / 4)
+            for handler in self.handlers():
+                handler.coalescer.flush_due()
+
+    def _dispatch_loop(self):
+        while self._running:
+            try:
+                handler, record = self.events.get(timeout=0.5)
+            except queue.Empty:
+                for handler in self.handlers():
+                    handler.maybe_recover()
+                continue
+            handler.handle(record)
+            if self.events.empty():
+                for handler in self.handlers():
+                    handler.maybe_recover()
+
+    def stop(self):
+        with self._lock:
+            for handler in list(self._handlers):
+                handler.active = False
+            self._handlers.clear()
+            if not self._running:
+                return
+            self._running = False
+        self.observer.stop()
+        self.observer.join()
+
+    def stats(self):
+        return {"roots": len(self._handlers), "queue_depth": self.events.qsize()}
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_manager():
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = WatcherManager()
+        return _shared
 
 
 class FolderWatcher:
-    def __init__(self, folder, modify_cb, delete_cb, move_cb):
+    def __init__(self, folder, modify_cb, delete_cb, move_cb, overflow_cb=None, manager=None):
         self.folder = folder
         self.modify_cb = modify_cb
         self.delete_cb = delete_cb
         self.move_cb = move_cb
-        self.observer = Observer()
+        self.overflow_cb = overflow_cb
+        self.manager = manager or shared_manager()
+        self.handler = None
         self.running = False
 
     def start(self):
         if self.running:
             return
-        handler = FolderHandler(self.modify_cb, self.delete_cb, self.move_cb)
-        self.observer.schedule(handler, self.folder, recursive=True)
-        self.observer.start()
+        self.handler = FolderHandler(
+            self.modify_cb, self.delete_cb, self.move_cb, self.overflow_cb, manager=self.manager
+        )
+        self.manager.add(self.folder, self.handler)
         self.running = True
 
     def stop(self):
         if not self.running:
             return
         self.running = False
-        self.observer.stop()
-        self.observer.join()
+        self.manager.remove(self.handler)
+
+    def stats(self):
+        if not self.handler:
+            return {"queue_depth": 0, "coalescing": 0, "evicted": 0, "enqueued": 0, "dropped": 0, "overflows": 0}
+        return self.handler.stats()
@@ -0,0 +1,77 @@
+import os
+import mmap
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from core import metrics
+
+ALGORITHMS = ("md5", "blake2b")
+BUFFER_SIZE = 1024 * 1024
+MMAP_CHUNK = 16 * 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+HASH_WORKERS = min(8, os.cpu_count() or 4)
+
+HASH_SECONDS = metrics.histogram("drivesync_hash_seconds", "Time spent hashing one file", ("algorithm",))
+HASH_BYTES = metrics.counter("drivesync_hash_bytes_total", "Bytes read by the hasher", ("algorithm",))
+
+
+class Hasher:
+    # md5 matches Drive's md5Checksum; blake2b is faster but only useful locally.
+    # mmap is opt-in: truncating a mapped file from another process raises SIGBUS.
+    def __init__(self, algorithm="md5", workers=HASH_WORKERS, buffer_size=BUFFER_SIZE, use_mmap=False):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.buffer_size = buffer_size
+        self.use_mmap = use_mmap
+        self.workers = workers
+        self._pool = None
+
+    def _new(self):
+        if self.algorithm == "blake2b":
+            return hashlib.blake2b()
+        return hashlib.md5()
+
+    def hash_file(self, path):
+        start = time.perf_counter()
+        h = self._new()
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if self.use_mmap and size >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    view = memoryview(m)
+                    try:
+                        for offset in range(0, size, MMAP_CHUNK):
+                            h.update(view[offset:offset + MMAP_CHUNK])
+                    finally:
+                        view.release()
+            else:
+                buf = bytearray(self.buffer_size)
+                view = memoryview(buf)
+                while True:
+                    n = f.readinto(buf)
+                    if not n:
+                        break
+                    h.update(view[:n])
+        HASH_SECONDS.observe(time.perf_counter() - start, algorithm=self.algorithm)
+        HASH_BYTES.inc(size, algorithm=self.algorithm)
+        return h.hexdigest()
+
+    def _safe_hash(self, path):
+        try:
+            return self.hash_file(path)
+        except:
+            return None
+
+    def hash_many(self, paths):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+        futures = {self._pool.submit(self._safe_hash, p): p for p in paths}
+        for fut in as_completed(futures):
+            yield futures[fut], fut.result()
+
+    def shutdown(self):
+        if self._pool:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -0,0 +1,290 @@
+import os
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 0 / empty disables the exporter.
+METRICS_PORT = int(os.environ.get("DRIVESYNC_METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("DRIVESYNC_METRICS_HOST", "127.0.0.1")
+METRICS_FILE = os.environ.get("DRIVESYNC_METRICS_FILE", "")
+METRICS_INTERVAL = float(os.environ.get("DRIVESYNC_METRICS_INTERVAL", "15"))
+LATENCY_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, key, extra=()):
+    pairs = list(zip(names, key)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in pairs) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def _items(self):
+        with self._lock:
+            return list(self._values.items())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        return [f"{self.name}{_label_text(self.labels, k)} {v}" for k, v in self._items()]
+
+    def snapshot(self):
+        return [{"labels": dict(zip(self.labels, k)), "value": v} for k, v in self._items()]
+
+
+class Gauge(Counter):
+    # A gauge is either set directly or computed from a callback at scrape time.
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, fn, **labels):
+        self.set(fn, **labels)
+
+    def clear_function(self, fn, **labels):
+        # Only if fn is still the registered callback, so an owner shutting
+        # down never removes its replacement's.
+        with self._lock:
+            key = self._key(labels)
+            if self._values.get(key) is fn:
+                del self._values[key]
+
+    def _items(self):
+        items = []
+        for k, v in super()._items():
+            if callable(v):
+                try:
+                    v = v()
+                except Exception:
+                    continue
+            items.append((k, v))
+        return items
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _items(self):
+        with self._lock:
+            return [(k, (list(s[0]), s[1], s[2])) for k, s in self._values.items()]
+
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in self._items():
+            running = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                running += n
+                lines.append(f"{self.name}_bucket{_label_text(self.labels, key, [('le', bound)])} {running}")
+            lines.append(f"{self.name}_sum{_label_text(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_label_text(self.labels, key)} {count}")
+        return lines
+
+    def snapshot(self):
+        out = []
+        for key, (counts, total, count) in self._items():
+            running, buckets = 0, {}
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                running += n
+                buckets[str(bound)] = running
+            out.append({"labels": dict(zip(self.labels, key)), "count": count, "sum": total, "buckets": buckets})
+        return out
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class TimedLock:
+    # Stands in for a Lock/RLock and records how long each acquire waited.
+    def __init__(self, histogram, inner=None, **labels):
+        self._inner = inner or threading.RLock()
+        self.histogram = histogram
+        self.labels = labels
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        got = self._inner.acquire(blocking, timeout)
+        self.histogram.observe(time.perf_counter() - start, **self.labels)
+        return got
+
+    def release(self):
+        self._inner.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        # Each metric is declared once, at module level in the module that
+        # owns it (or below for ones several modules feed), and imported elsewhere.
+        with self._lock:
+            if name in self._metrics:
+                raise ValueError(f"metric {name} is already declared")
+            metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def _sorted(self):
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda m: m.name)
+
+    def render(self):
+        lines = []
+        for m in self._sorted():
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "time": time.time(),
+            "metrics": {m.name: {"type": m.kind, "help": m.help, "values": m.snapshot()} for m in self._sorted()},
+        }
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# Fed by more than one module.
+QUEUE_DEPTH = gauge("drivesync_queue_depth", "Items waiting in each pipeline stage", ("stage",))
+API_CALLS = counter("drivesync_api_calls_total", "Drive API requests by method", ("method",))
+API_ERRORS = counter("drivesync_api_errors_total", "Failed Drive API requests by method", ("method",))
+API_SECONDS = histogram("drivesync_api_seconds", "Drive API request latency by method", ("method",))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path in ("/", "/metrics"):
+            body, ctype = self.registry.render().encode(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, ctype = json.dumps(self.registry.snapshot()).encode(), "application/json"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=METRICS_PORT, host=METRICS_HOST):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def write_json(path, registry=REGISTRY):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(registry.snapshot(), f)
+    os.replace(tmp, path)
+
+
+def _write_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_json(path)
+        except Exception as e:
+            print("[METRICS ERROR]", e)
+
+
+_started = []
+
+
+def start_exporters():
+    if _started:
+        return
+    _started.append(True)
+    if METRICS_PORT:
+        try:
+            serve()
+            print("[METRICS]", f"serving http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            print("[METRICS ERROR]", e)
+    if METRICS_FILE:
+        threading.Thread(target=_write_loop, args=(METRICS_FILE, METRICS_INTERVAL),
+                         name="metrics-file", daemon=True).start()
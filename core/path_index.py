@@ -0,0 +1,89 @@
+import os
+
+
+def _split(path):
+    drive, rest = os.path.splitdrive(os.path.abspath(path))
+    return [drive or os.sep] + [p for p in rest.split(os.sep) if p]
+
+
+class PathIndex:
+    def __init__(self, paths=()):
+        self._root = {}
+        self._count = 0
+        for p in paths:
+            self.add(p)
+
+    def __len__(self):
+        return self._count
+
+    def add(self, path):
+        node = self._root
+        for part in _split(path):
+            node = node.setdefault(part, {})
+        if None not in node:
+            self._count += 1
+        node[None] = os.path.abspath(path)
+
+    def remove(self, path):
+        trail = []
+        node = self._root
+        for part in _split(path):
+            child = node.get(part)
+            if child is None:
+                return False
+            trail.append((node, part))
+            node = child
+        if None not in node:
+            return False
+        del node[None]
+        self._count -= 1
+        for parent, part in reversed(trail):
+            if parent[part]:
+                break
+            del parent[part]
+        return True
+
+    def remove_subtree(self, path):
+        node = self._root
+        trail = []
+        for part in _split(path):
+            child = node.get(part)
+            if child is None:
+                return []
+            trail.append((node, part))
+            node = child
+        removed = []
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            for k, v in n.items():
+                if k is None:
+                    removed.append(v)
+                else:
+                    stack.append(v)
+        parent, part = trail[-1]
+        del parent[part]
+        self._count -= len(removed)
+        for parent, part in reversed(trail[:-1]):
+            if parent[part]:
+                break
+            del parent[part]
+        return removed
+
+    def deepest(self, path):
+        node = self._root
+        found = node.get(None)
+        for part in _split(path):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def __contains__(self, path):
+        node = self._root
+        for part in _split(path):
+            node = node.get(part)
+            if node is None:
+                return False
+        return None in node
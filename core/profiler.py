@@ -0,0 +1,143 @@
+import os
+import sys
+import time
+import signal
+import threading
+import tracemalloc
+from collections import Counter
+
+from core.sync_engine import APP_DATA_DIR
+from core.folder_watcher import shared_manager
+
+PROFILE_DIR = os.environ.get("DRIVESYNC_PROFILE_DIR", str(APP_DATA_DIR / "profiles"))
+SAMPLE_INTERVAL = float(os.environ.get("DRIVESYNC_PROFILE_INTERVAL", "0.01"))
+TRACE_FRAMES = 1
+TOP_SITES = 30
+SIZE_SAMPLE = 2000
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def _approx_size(n, items):
+    # Estimates the memory held by a table of n small dicts/objects from a
+    # sample of its items, so summarising a million-entry table stays cheap.
+    if not items:
+        return 0
+    per_item = 0
+    for k, v in items:
+        per_item += sys.getsizeof(k) + sys.getsizeof(v)
+        if isinstance(v, dict):
+            per_item += sum(sys.getsizeof(x) for x in v.values())
+    return per_item * n // len(items)
+
+
+class Profiler:
+    # Samples every thread's stack into collapsed-stack counts (flame graph
+    # input) and traces allocations with tracemalloc; stop() writes both next
+    # to a summary of the engine's biggest in-memory tables.
+    def __init__(self, engine_fn=None, out_dir=PROFILE_DIR, interval=SAMPLE_INTERVAL):
+        self.engine_fn = engine_fn
+        self.out_dir = out_dir
+        self.interval = interval
+        self.running = False
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._started = 0
+        self._owns_tracemalloc = False
+
+    def toggle(self):
+        return self.stop() if self.running else self.start()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return None
+            self.running = True
+        self._stacks = Counter()
+        self._stop.clear()
+        self._started = time.time()
+        self._owns_tracemalloc = not tracemalloc.is_tracing()
+        if self._owns_tracemalloc:
+            tracemalloc.start(TRACE_FRAMES)
+        self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+        self._sampler.start()
+        print("[PROFILE]", "started")
+        return None
+
+    def stop(self):
+        with self._lock:
+            if not self.running:
+                return None
+            self.running = False
+        self._stop.set()
+        self._sampler.join()
+        snapshot = tracemalloc.take_snapshot()
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(self.out_dir, exist_ok=True)
+        base = os.path.join(self.out_dir, "profile-" + time.strftime("%Y%m%d-%H%M%S", time.localtime(self._started)))
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(base + ".memory.txt", "w", encoding="utf-8") as f:
+            f.write(self._memory_report(snapshot))
+        print("[PROFILE]", "written to", base + ".*")
+        return base
+
+    def _sample_loop(self):
+        me = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[";".join(reversed(stack))] += 1
+
+    def _memory_report(self, snapshot):
+        lines = [f"Profile of {time.time() - self._started:.1f}s, {sum(self._stacks.values())} stack samples", ""]
+
+        lines.append("Tracked structures (approximate):")
+        engine = self.engine_fn() if self.engine_fn else None
+        if engine is not None:
+            for name, (n, items) in engine.table_samples(SIZE_SAMPLE).items():
+                lines.append(f"  SyncEngine.{name}: {n} entries, ~{_approx_size(n, items) / 1e6:.1f} MB")
+        # The coalescer's pending map is what replaced FolderHandler.last_event.
+        for handler in shared_manager().handlers():
+            coalescer = handler.coalescer
+            n, items = coalescer.pending_sample(SIZE_SAMPLE)
+            lines.append(f"  EventCoalescer pending ({coalescer.evicted} evicted): "
+                         f"{n} paths, ~{_approx_size(n, items) / 1e6:.1f} MB")
+        lines.append("")
+
+        ours = [s for s in snapshot.statistics("lineno")
+                if any(m in s.traceback[0].filename for m in ("sync_engine", "folder_watcher", "tracking_store", "path_index"))]
+        lines.append("Top allocating sites in the engine and watcher:")
+        for stat in ours[:TOP_SITES]:
+            lines.append(f"  {stat.size / 1024:10.1f} KiB {stat.count:>9} blocks  {stat.traceback[0]}")
+        lines.append("")
+
+        lines.append("Top allocating sites overall:")
+        for stat in snapshot.statistics("lineno")[:TOP_SITES]:
+            lines.append(f"  {stat.size / 1024:10.1f} KiB {stat.count:>9} blocks  {stat.traceback[0]}")
+        return "\n".join(lines) + "\n"
+
+
+def install_signal(toggle, signum=getattr(signal, "SIGUSR1", None)):
+    # Headless runs: `kill -USR1 <pid>` toggles profiling. Not available on Windows.
+    if signum is None:
+        return False
+    signal.signal(signum, lambda *_: toggle())
+    return True
@@ -0,0 +1,111 @@
+import os
+import time
+import random
+import threading
+from googleapiclient.errors import HttpError
+
+from core import metrics
+
+API_RATE = float(os.environ.get("DRIVESYNC_API_RATE", "50"))
+API_BURST = 100
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 64
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ("userRateLimitExceeded", "rateLimitExceeded")
+
+RETRIES = metrics.counter("drivesync_api_retries_total", "Drive requests retried after a failure", ("reason",))
+THROTTLE_SECONDS = metrics.histogram("drivesync_api_throttle_seconds", "Time spent waiting for API tokens")
+
+
+class DriveError(Exception):
+    def __init__(self, message, retryable=False, cause=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.cause = cause
+
+
+def is_rate_limited(exc):
+    if not isinstance(exc, HttpError):
+        return False
+    status = exc.resp.status
+    return status == 429 or (status == 403 and any(r in str(exc) for r in RATE_LIMIT_REASONS))
+
+
+def is_retryable(exc):
+    if isinstance(exc, HttpError):
+        return exc.resp.status in RETRYABLE_STATUS or is_rate_limited(exc)
+    # Dropped connections and socket timeouts surface as OSError subclasses.
+    return isinstance(exc, OSError)
+
+
+def is_not_found(exc):
+    exc = getattr(exc, "cause", None) or exc
+    return isinstance(exc, HttpError) and exc.resp.status in (404, 410)
+
+
+def retry_after(exc):
+    try:
+        return float(exc.resp.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
+def backoff_delay(attempt, exc=None):
+    # Full jitter keeps threads that failed together from retrying together.
+    delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+    return max(delay, retry_after(exc)) if exc is not None else delay
+
+
+class TokenBucket:
+    def __init__(self, rate=API_RATE, burst=API_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def acquire(self, n=1):
+        start = time.perf_counter()
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if now >= self._paused_until and self._tokens >= n:
+                    self._tokens -= n
+                    THROTTLE_SECONDS.observe(time.perf_counter() - start)
+                    return
+                wait = max(self._paused_until - now, (n - self._tokens) / self.rate)
+            time.sleep(min(wait, 1.0))
+
+
+class RateLimiter:
+    def __init__(self, bucket=None, max_retries=MAX_RETRIES):
+        self.bucket = bucket or TokenBucket()
+        self.max_retries = max_retries
+
+    def note_failure(self, exc, attempt):
+        delay = backoff_delay(attempt, exc)
+        RETRIES.inc(reason="rate_limit" if is_rate_limited(exc) else "transient")
+        if is_rate_limited(exc):
+            # Quota errors apply to the whole account, so every caller backs off.
+            self.bucket.pause(delay)
+        return delay
+
+    def call(self, fn, *args, cost=1, **kwargs):
+        attempt = 0
+        while True:
+            self.bucket.acquire(cost)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                time.sleep(self.note_failure(e, attempt))
+                attempt += 1
@@ -0,0 +1,52 @@
+import threading
+
+POLL_INTERVAL = 60
+PAGE_TOKEN_KEY = "changes_page_token"
+
+
+class RemoteChangePoller:
+    # Follows the Drive changes feed from a page token persisted in the
+    # tracking store, so each poll costs time proportional to the number of
+    # remote changes rather than the size of the tree.
+    def __init__(self, drive_client, sync_engine, on_change=None, interval=POLL_INTERVAL):
+        self.drive = drive_client
+        self.engine = sync_engine
+        self.on_change = on_change
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name="remote-changes", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                print("[CHANGES ERROR]", e)
+            self._stop.wait(self.interval)
+
+    def poll_once(self):
+        store = self.engine.store
+        token = store.get("meta", PAGE_TOKEN_KEY)
+        if not token:
+            token = self.drive.get_start_page_token()
+            if token:
+                store.put("meta", PAGE_TOKEN_KEY, token)
+            return []
+        result = self.drive.list_changes(token)
+        if result is None:
+            return []
+        changes, new_token = result
+        detected = self.engine.match_remote_changes(changes)
+        store.put("meta", PAGE_TOKEN_KEY, new_token)
+        if detected and self.on_change:
+            self.on_change(detected)
+        return detected
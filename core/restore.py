@@ -0,0 +1,107 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from core.drive_client import FOLDER_MIME
+from core.hasher import Hasher
+
+RESTORE_WORKERS = 4
+
+
+def safe_join(parent_dir, name, real_root):
+    # Drive names may contain separators, "..", drive letters or absolute
+    # paths; only a plain name that resolves inside the root is accepted.
+    seps = [s for s in (os.sep, os.altsep) if s]
+    if (not name or name in (".", "..") or "\0" in name or any(s in name for s in seps)
+            or os.path.isabs(name) or os.path.splitdrive(name)[0]):
+        return None
+    path = os.path.join(parent_dir, name)
+    real = os.path.realpath(path)
+    if real != real_root and not real.startswith(real_root.rstrip(os.sep) + os.sep):
+        return None
+    return path
+
+
+class Restorer:
+    # Downloads a synced root back from Drive. Files whose local copy already
+    # has the same md5 are only re-tracked; Google-native documents (no
+    # md5Checksum) cannot be fetched with get_media and are skipped.
+    def __init__(self, drive_client, sync_engine, workers=RESTORE_WORKERS, on_progress=None):
+        self.drive = drive_client
+        self.engine = sync_engine
+        self.workers = workers
+        self.on_progress = on_progress
+        self._lock = threading.Lock()
+        self.downloaded = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def restore(self, local_root, root_id=None):
+        local_root = os.path.abspath(local_root)
+        os.makedirs(local_root, exist_ok=True)
+        # An unregistered root is looked up on Drive by name, as register_folder does.
+        root_id = root_id or self.engine.register_folder(local_root)
+        if not root_id:
+            return False
+        self.engine.adopt_folder(local_root, root_id)
+        local_dirs = {root_id: local_root}
+        real_root = os.path.realpath(local_root)
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="restore") as pool:
+            futures = []
+            for parent_id, f in self.drive.walk_tree(root_id):
+                parent_dir = local_dirs.get(parent_id)
+                if parent_dir is None:
+                    continue
+                path = safe_join(parent_dir, f.get("name", ""), real_root)
+                if path is None:
+                    # Nothing below an unsafe folder is restored either.
+                    print("[RESTORE ERROR]", "unsafe name skipped:", repr(f.get("name")))
+                    self._count("failed")
+                    continue
+                if f.get("mimeType") == FOLDER_MIME:
+                    os.makedirs(path, exist_ok=True)
+                    local_dirs[f["id"]] = path
+                    self.engine.adopt_folder(path, f["id"])
+                elif f.get("md5Checksum"):
+                    futures.append(pool.submit(self._restore_file, path, f))
+            for fut in futures:
+                fut.result()
+        self.engine.save_db()
+        return self.failed == 0
+
+    def _restore_file(self, path, f):
+        md5 = f["md5Checksum"]
+        use_md5 = self.engine.hasher.algorithm == "md5"
+        try:
+            unchanged = os.path.isfile(path) and Hasher("md5").hash_file(path) == md5
+        except OSError:
+            unchanged = False
+        if unchanged:
+            self.engine.adopt_file(path, f["id"], md5 if use_md5 else self.engine.file_hash(path))
+            self._count("skipped")
+            return
+
+        digest = [md5]
+
+        def before_replace(tmp):
+            # Track the file before it appears so the watcher sees a known hash.
+            if not use_md5:
+                digest[0] = self.engine.file_hash(tmp)
+            self.engine.adopt_file(path, f["id"], digest[0])
+
+        try:
+            ok = self.drive.download_file(f["id"], path, f.get("size"), md5, before_replace)
+        except Exception as e:
+            print("[RESTORE ERROR]", path, e)
+            ok = False
+        if ok:
+            self.engine.adopt_file(path, f["id"], digest[0])
+        self._count("downloaded" if ok else "failed")
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+            done = self.downloaded + self.skipped + self.failed
+        if self.on_progress:
+            self.on_progress(done, self.downloaded, self.failed)
@@ -1,12 +1,21 @@
 import os
-import hashlib
-import json
+import stat
 import threading
 import time
 import subprocess
 from pathlib import Path
 import platform
-import tempfile
+from collections import deque
+from itertools import islice
+
+from core.tracking_store import TrackingStore
+from core.path_index import PathIndex
+from core.hasher import Hasher, HASH_WORKERS
+from core.work_pool import KeyedExecutor, TaskTally, INTERACTIVE, NORMAL, BACKGROUND
+from core.tree_walker import walk_parallel, WALK_WORKERS
+from core.rate_limit import is_not_found
+from core import metrics
+from core.metrics import QUEUE_DEPTH
 
 if platform.system() == "Windows":
     APP_DATA_DIR = Path(os.getenv("APPDATA")) / "DriveSync"
@@ -14,33 +23,149 @@ else:
     APP_DATA_DIR = Path.home() / ".config" / "DriveSync"
 
 APP_DATA_DIR.mkdir(parents=True, exist_ok=True)
-TRACKING_DB = str(APP_DATA_DIR / "sync_tracking.json")
+TRACKING_DB = str(APP_DATA_DIR / "sync_tracking.db")
+LEGACY_TRACKING_JSON = str(APP_DATA_DIR / "sync_tracking.json")
+HASH_BATCH = 256
+FOLDER_BATCH = 64
+UPLOAD_WORKERS = int(os.environ.get("DRIVESYNC_UPLOAD_WORKERS", "4"))
+DEDUP_MIN_SIZE = 1024 * 1024
+PAIR_WINDOW = 2.0
+CLOSE_TIMEOUT = 30
+RETRY_INTERVAL = int(os.environ.get("DRIVESYNC_RETRY_INTERVAL", "300"))
+
+LOCK_WAIT = metrics.histogram("drivesync_lock_wait_seconds", "Time spent waiting to acquire a lock", ("lock",))
+STAGE_SECONDS = metrics.histogram("drivesync_stage_seconds", "Time spent per file in each sync stage", ("stage",))
+FILES = metrics.counter("drivesync_files_total", "Files handled by the engine by outcome", ("outcome",))
+
+
+def stat_fields(st):
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "dev": st.st_dev}
+
+
+def stat_matches(entry, st):
+    return all(entry.get(k) == v for k, v in stat_fields(st).items())
 
 
 class SyncEngine:
-    def __init__(self, drive_client):
+    def __init__(self, drive_client, paranoid=None, workers=None, walk_workers=WALK_WORKERS):
         self.drive = drive_client
-        self._lock = threading.RLock()
-        if os.path.exists(TRACKING_DB):
-            try:
-                with open(TRACKING_DB, "r", encoding="utf-8") as f:
-                    self.db = json.load(f)
-            except:
-                self.db = {"folders": {}, "files": {}}
-        else:
-            self.db = {"folders": {}, "files": {}}
+        if paranoid is None:
+            paranoid = os.environ.get("DRIVESYNC_PARANOID") == "1"
+        self.paranoid = paranoid
+        self.walk_workers = walk_workers
+        self.hasher = Hasher(os.environ.get("DRIVESYNC_HASH", "md5"))
+        self._lock = metrics.TimedLock(LOCK_WAIT, threading.RLock(), lock="engine")
+        self.store = TrackingStore(TRACKING_DB, legacy_json=LEGACY_TRACKING_JSON)
+        self.db = {
+            "folders": self.store.load("folders"),
+            "files": self.store.load("files"),
+        }
+        self._folder_index = PathIndex(self.db["folders"])
+        self._roots = PathIndex()
+        self._by_hash = {}
+        self._by_id = {folder_id: path for path, folder_id in self.db["folders"].items()}
+        for path, entry in self.db["files"].items():
+            self._index_file(path, entry)
+        self.dedup_copies = 0
+        self.bytes_saved = 0
+        self._parked = {}
+        self._reaper_started = False
+        self._closed = False
+        self._stopping = threading.Event()
+        self._retry_started = False
+        self._remote_ops = 0
+        self._remote_done = threading.Condition()
+        self.hashing = KeyedExecutor(HASH_WORKERS, name="hash", max_pending=4 * HASH_BATCH)
+        self.uploads = KeyedExecutor(workers or UPLOAD_WORKERS, name="upload", max_pending=4 * HASH_BATCH)
+        self._rescans = set()
+        self._depth_gauges = {
+            "hash": lambda: self.hashing.pending,
+            "upload": lambda: self.uploads.pending,
+            "held_deletes": lambda: sum(map(len, self._parked.values())),
+        }
+        for stage, fn in self._depth_gauges.items():
+            QUEUE_DEPTH.set_function(fn, stage=stage)
 
     def save_db(self):
+        self.store.flush()
+
+    def close(self):
+        self._closed = True
+        self._stopping.set()
+        for stage, fn in self._depth_gauges.items():
+            QUEUE_DEPTH.clear_function(fn, stage=stage)
+        self._reap_parked(float("inf"))
+        self.hashing.shutdown()
+        self.uploads.shutdown()
+        self.hasher.shutdown()
+        # Let in-flight deletes and moves record their outcome; any still
+        # running after the timeout are replayed from the store next start.
+        with self._remote_done:
+            self._remote_done.wait_for(lambda: not self._remote_ops, CLOSE_TIMEOUT)
+        self.store.close()
+
+    def _set_folder(self, path, folder_id):
+        self.db["folders"][path] = folder_id
+        self._folder_index.add(path)
+        self._by_id[folder_id] = path
+        self.store.put("folders", path, folder_id)
+
+    def _index_file(self, path, entry):
+        if entry.get("hash"):
+            self._by_hash.setdefault(entry["hash"], set()).add(path)
+        if entry.get("id"):
+            self._by_id[entry["id"]] = path
+
+    def _unindex_file(self, path, entry):
+        if not entry:
+            return
+        paths = self._by_hash.get(entry.get("hash"))
+        if paths is not None:
+            paths.discard(path)
+            if not paths:
+                del self._by_hash[entry["hash"]]
+        if self._by_id.get(entry.get("id")) == path:
+            del self._by_id[entry["id"]]
+
+    def _set_file(self, path, entry):
+        self._unindex_file(path, self.db["files"].get(path))
+        self.db["files"][path] = entry
+        self._index_file(path, entry)
+        self.store.put("files", path, entry)
+
+    def _drop_file(self, path):
+        self._unindex_file(path, self.db["files"].pop(path, None))
+        self.store.delete("files", path)
+        self.store.delete("uploads", path)
+
+    def match_remote_changes(self, changes):
+        detected = []
         with self._lock:
-            try:
-                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(TRACKING_DB))
-                with os.fdopen(fd, "w", encoding="utf-8") as f:
-                    json.dump(self.db, f, indent=2, ensure_ascii=False)
-                    f.flush()
-                    os.fsync(f.fileno())
-                os.replace(tmp, TRACKING_DB)
-            except:
-                pass
+            for change in changes:
+                path = self._by_id.get(change.get("fileId"))
+                if not path:
+                    continue
+                meta = change.get("file") or {}
+                entry = self.db["files"].get(path)
+                kind = "file" if entry and entry.get("id") == change["fileId"] else "folder"
+                # A sync root's local parent is not registered, so its Drive
+                # parent cannot be compared.
+                parent_id = self.db["folders"].get(os.path.dirname(path))
+                if change.get("removed") or meta.get("trashed"):
+                    action = "deleted"
+                elif meta.get("name") and meta["name"] != os.path.basename(path):
+                    action = "renamed"
+                elif meta.get("parents") and parent_id and parent_id not in meta["parents"]:
+                    action = "moved"
+                elif kind == "file" and self.hasher.algorithm == "md5" and meta.get("md5Checksum") \
+                        and meta["md5Checksum"] != entry.get("hash"):
+                    action = "modified"
+                else:
+                    # Our own upload echoing back, or a metadata-only change.
+                    continue
+                detected.append({"action": action, "kind": kind, "path": path,
+                                 "file_id": change["fileId"], "file": meta})
+        return detected
 
     def hydrate(self, path):
         if platform.system() != "Windows":
@@ -58,11 +183,8 @@ class SyncEngine:
 
     def file_hash(self, path):
         try:
-            h = hashlib.md5()
-            with open(path, "rb") as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    h.update(chunk)
-            return h.hexdigest()
+            with STAGE_SECONDS.time(stage="hash"):
+                return self.hasher.hash_file(path)
         except:
             return None
 
@@ -75,36 +197,112 @@ class SyncEngine:
             try:
                 folder_id = self.drive.create_or_get_folder(name, parent_id)
                 if not folder_id:
-                    return None
-                self.db["folders"][local_folder] = folder_id
-                self.save_db()
-                return folder_id
-            except:
+                    raise Exception("folder lookup returned no id")
+            except Exception as e:
+                self._dead_letter("folder", local_folder, e, path=local_folder, parent_id=parent_id)
                 return None
+            self._set_folder(local_folder, folder_id)
+        self.store.delete("dead_letters", f"folder:{local_folder}")
+        return folder_id
 
-    def _find_root_folder(self, path):
-        path = os.path.abspath(path)
+    def register_folders(self, pairs):
         with self._lock:
-            matches = []
-            for f in self.db["folders"]:
-                try:
-                    if os.path.commonpath([os.path.abspath(f), path]) == os.path.abspath(f):
-                        matches.append(os.path.abspath(f))
-                except:
-                    if path.startswith(os.path.abspath(f)):
-                        matches.append(os.path.abspath(f))
-            if not matches:
+            todo = [(os.path.abspath(p), parent) for p, parent in pairs
+                    if os.path.abspath(p) not in self.db["folders"]]
+        if not todo:
+            return
+        names = [(os.path.basename(p.rstrip(os.sep)) or p, parent) for p, parent in todo]
+        try:
+            results = self.drive.create_folders(names)
+        except Exception as e:
+            results = [e] * len(todo)
+        failed = []
+        with self._lock:
+            for (path, parent), result in zip(todo, results):
+                if isinstance(result, Exception) or not result:
+                    failed.append((path, parent, result or Exception("folder lookup returned no id")))
+                elif path not in self.db["folders"]:
+                    self._set_folder(path, result)
+        for path, parent, error in failed:
+            self._dead_letter("folder", path, error, path=path, parent_id=parent)
+        for (path, _), result in zip(todo, results):
+            if not isinstance(result, Exception) and result:
+                self.store.delete("dead_letters", f"folder:{path}")
+
+    def _ensure_folder(self, local_folder):
+        # Registers local_folder and any missing folders between it and its
+        # nearest registered ancestor, returning its Drive ID.
+        local_folder = os.path.abspath(local_folder)
+        with self._lock:
+            folder_id = self.db["folders"].get(local_folder)
+            base = self._folder_index.deepest(local_folder)
+        if folder_id or not base:
+            return folder_id
+        path, folder_id = base, self.db["folders"][base]
+        for part in os.path.relpath(local_folder, base).split(os.sep):
+            path = os.path.join(path, part)
+            folder_id = self.register_folder(path, folder_id)
+            if not folder_id:
                 return None
-            return max(matches, key=len)
+        return folder_id
+
+    def adopt_folder(self, local_folder, folder_id):
+        local_folder = os.path.abspath(local_folder)
+        with self._lock:
+            if self.db["folders"].get(local_folder) != folder_id:
+                self._set_folder(local_folder, folder_id)
+
+    def adopt_file(self, path, file_id, digest):
+        # Records a file that already matches its Drive copy (e.g. after a
+        # restore) so it is never uploaded again.
+        path = os.path.abspath(path)
+        entry = {"id": file_id, "hash": digest}
+        try:
+            entry.update(stat_fields(os.stat(path)))
+        except OSError:
+            pass
+        with self._lock:
+            self._set_file(path, entry)
+
+    def unregister_folder(self, local_folder):
+        local_folder = os.path.abspath(local_folder)
+        with self._lock:
+            for path in self._folder_index.remove_subtree(local_folder):
+                folder_id = self.db["folders"].pop(path, None)
+                if self._by_id.get(folder_id) == path:
+                    del self._by_id[folder_id]
+                self.store.delete("folders", path)
+            self._roots.remove_subtree(local_folder)
+            self._forget_snapshot(local_folder)
+
+    # Sync roots are the folders the user chose (sync_folder, watchers); they
+    # are the fairness groups for scheduling, not every registered subfolder.
+    def add_root(self, local_folder):
+        with self._lock:
+            self._roots.add(os.path.abspath(local_folder))
+
+    def _find_sync_root(self, path):
+        with self._lock:
+            return self._roots.deepest(path)
 
-    def sync_file(self, path, retry=1):
+    def sync_file(self, path, retry=1, known=None):
         path = os.path.abspath(path)
-        if os.path.isdir(path):
+        try:
+            st = os.stat(path)
+        except OSError:
             return
-        if not os.path.exists(path):
+        if stat.S_ISDIR(st.st_mode):
             return
-        self.hydrate(path)
-        h = self.file_hash(path)
+        with self._lock:
+            existing = self.db["files"].get(path)
+        if existing and not self.paranoid and stat_matches(existing, st):
+            FILES.inc(outcome="unchanged")
+            return
+        if known and known[1] and stat_matches(stat_fields(known[0]), st):
+            h = known[1]
+        else:
+            self.hydrate(path)
+            h = self.file_hash(path)
         if h is None:
             if retry > 0:
                 time.sleep(0.2)
@@ -113,82 +311,585 @@ class SyncEngine:
         with self._lock:
             existing = self.db["files"].get(path)
             if existing and existing.get("hash") == h:
+                if not stat_matches(existing, st):
+                    self._set_file(path, {**existing, **stat_fields(st)})
+                FILES.inc(outcome="unchanged")
                 return
-            root = self._find_root_folder(path)
-            if not root:
-                return
-            parent_id = self.db["folders"].get(root)
+            parent_id = self.db["folders"].get(os.path.dirname(path))
+        if not parent_id:
+            # A directory the scan has not reached yet, or one the watcher
+            # only told us about through this file.
+            parent_id = self._ensure_folder(os.path.dirname(path))
             if not parent_id:
                 return
+        with self._lock:
+            parked = None if existing else self._claim_parked(st.st_size, h)
+        if parked:
+            _, entry, old_parent = parked
+            self._move_remote(entry["id"], os.path.basename(path), parent_id, old_parent)
+            with self._lock:
+                self._set_file(path, {**entry, **stat_fields(st)})
+                self.store.delete("deletes", entry["id"])
+            FILES.inc(outcome="moved")
+            return
+        if not existing and st.st_size >= DEDUP_MIN_SIZE and self._copy_duplicate(path, h, st, parent_id):
+            return
+        known_id = existing.get("id") if existing else None
+        session = self._resumable_session(path, st, known_id)
+
+        def on_session(uri, offset):
+            self.store.put("uploads", path, {
+                "uri": uri, "offset": offset, "file_id": known_id, **stat_fields(st)
+            })
+
         try:
-            file_id = self.drive.upload_or_update(path, parent_id)
+            with STAGE_SECONDS.time(stage="upload"):
+                file_id = self.drive.upload_or_update(path, parent_id, known_id, session, on_session)
             if not file_id:
-                raise Exception()
-        except:
-            if retry > 0:
-                time.sleep(0.5)
-                return self.sync_file(path, retry - 1)
+                raise Exception("upload returned no file id")
+        except Exception as e:
+            # The client has already retried transient failures with backoff.
+            self._dead_letter("sync", path, e, path=path)
             return
         with self._lock:
-            self.db["files"][path] = {"id": file_id, "hash": h}
-            self.save_db()
+            self._set_file(path, {"id": file_id, "hash": h, **stat_fields(st)})
+            self.store.delete("uploads", path)
+        self.store.delete("dead_letters", f"sync:{path}")
+        FILES.inc(outcome="uploaded")
+
+    def _copy_duplicate(self, path, h, st, parent_id):
+        with self._lock:
+            sources = [self.db["files"][p] for p in self._by_hash.get(h, ())
+                       if p != path and self.db["files"][p].get("size") == st.st_size]
+        for source in sources:
+            try:
+                file_id = self.drive.copy_file(source["id"], os.path.basename(path), parent_id)
+            except:
+                file_id = None
+            if file_id:
+                with self._lock:
+                    self._set_file(path, {"id": file_id, "hash": h, **stat_fields(st)})
+                    self.dedup_copies += 1
+                    self.bytes_saved += st.st_size
+                FILES.inc(outcome="dedup")
+                print("[DEDUP]", path, f"copied server-side, {self.bytes_saved} bytes saved so far")
+                return True
+        return False
+
+    def _resumable_session(self, path, st, file_id):
+        session = self.store.get("uploads", path)
+        if not session:
+            return None
+        # A session is only valid for the exact bytes it started with.
+        if session.get("file_id") != file_id or not stat_matches(session, st):
+            self.store.delete("uploads", path)
+            return None
+        return session
 
     def sync_folder(self, local_folder):
         local_folder = os.path.abspath(local_folder)
+        self.add_root(local_folder)
         root_id = self.register_folder(local_folder)
         if not root_id:
             return
-        for root, dirs, files in os.walk(local_folder):
-            root = os.path.abspath(root)
-            try:
-                parent_local = self._find_root_folder(root)
-                parent_id = self.db["folders"].get(parent_local, root_id)
-            except:
-                parent_id = root_id
-            if root not in self.db["folders"]:
-                self.register_folder(root, parent_id)
-            for d in dirs:
-                sub = os.path.abspath(os.path.join(root, d))
-                if sub not in self.db["folders"]:
-                    self.register_folder(sub, self.db["folders"].get(root, parent_id))
-            for f in files:
-                fp = os.path.join(root, f)
-                try:
-                    self.sync_file(fp)
-                except:
-                    pass
+        prefetched = []
+        # Waiting on the pools as a whole could take forever while other
+        # roots keep them busy, so only this scan's own tasks are counted.
+        tally = TaskTally()
+
+        # Only pay for the remote listing once something actually needs a lookup.
+        def ensure_prefetched():
+            if not prefetched:
+                prefetched.append(True)
+                self.drive.prefetch_tree(root_id)
+
+        # Deletions are tracked files that a scan no longer finds, so they
+        # never depend on a snapshot having been written before a crash.
+        prefix = local_folder + os.sep
+        tracked = {}
+        with self._lock:
+            for p in self.db["files"]:
+                if p.startswith(prefix):
+                    tracked.setdefault(os.path.dirname(p), []).append(p)
+
+        batch = []
+        deleted = []
+        visited = set()
+        records = []
+
+        # Folders for a chunk of directories are created together, so the
+        # client's batch calls fill up instead of carrying one directory each.
+        def flush_records():
+            self._register_chunk(records, ensure_prefetched)
+            for root, _, files, _ in records:
+                # A directory without a folder is dead-lettered; the replay rescans it.
+                if root in self.db["folders"]:
+                    batch.extend(files)
+            records.clear()
+            if len(batch) >= HASH_BATCH:
+                self._sync_batch(batch, ensure_prefetched, tally)
+                batch.clear()
+
+        for record in walk_parallel(local_folder, self._scan_dir, self.walk_workers):
+            root, _, _, seen = record
+            visited.add(root)
+            if seen is None:
+                # Unreadable right now; leave whatever is tracked below it alone.
+                for d in [d for d in tracked if d == root or d.startswith(root + os.sep)]:
+                    del tracked[d]
+                continue
+            deleted.extend(p for p in tracked.pop(root, ()) if os.path.basename(p) not in seen)
+            records.append(record)
+            if len(records) >= FOLDER_BATCH:
+                flush_records()
+        flush_records()
+        self._sync_batch(batch, ensure_prefetched, tally)
+        # Whatever is left was under directories that no longer exist.
+        for paths in tracked.values():
+            deleted.extend(paths)
+        for path in deleted:
+            # A snapshot can miss a file created within the same mtime tick.
+            if not os.path.lexists(path):
+                self.enqueue_delete(path, tally)
+        with self._lock:
+            folders = [d for d in self.db["folders"] if d.startswith(prefix) and d not in visited]
+        for d in folders:
+            if not os.path.isdir(d):
+                self.unregister_folder(d)
+        tally.wait(lambda: self._closed)
         self.save_db()
 
+    # Each round registers, in one create_folders call, every missing folder
+    # in the chunk whose parent is known; a directory created in one round
+    # gets its subfolders in the next.
+    def _register_chunk(self, records, before_lookup):
+        while True:
+            pairs = {}
+            with self._lock:
+                folders = self.db["folders"]
+                for root, subs, _, _ in records:
+                    folder_id = folders.get(root)
+                    if folder_id:
+                        pairs.update((sub, folder_id) for sub in subs if sub not in folders)
+                    elif os.path.dirname(root) in folders:
+                        pairs[root] = folders[os.path.dirname(root)]
+            if not pairs:
+                return
+            before_lookup()
+            self.register_folders(list(pairs.items()))
+            with self._lock:
+                if not any(p in self.db["folders"] for p in pairs):
+                    return
+
+    # Scans one directory for walk_parallel, using a persisted snapshot of
+    # its mtime and entry names. A directory whose mtime is unchanged reuses
+    # its snapshot instead of being listed again; files are still stat'ed
+    # because editing a file in place does not touch its directory's mtime.
+    # Returns the regular files found plus the set of names present, or
+    # None for that set when the directory could not be read.
+    def _scan_dir(self, d):
+        try:
+            dir_st = os.stat(d)
+        except OSError:
+            return d, [], [], None
+        snap = self.store.get("dirs", d)
+        if snap and snap.get("mtime_ns") == dir_st.st_mtime_ns:
+            subdirs, files, seen = self._scan_from_snapshot(d, snap)
+        else:
+            subdirs, files, seen = self._scan_listing(d, dir_st, snap)
+        return d, [os.path.join(d, name) for name in subdirs], files, seen
+
+    def _scan_from_snapshot(self, d, snap):
+        files, seen = [], set()
+        changed = False
+        for name in snap.get("files", []):
+            p = os.path.join(d, name)
+            try:
+                st = os.stat(p)
+            except FileNotFoundError:
+                changed = True
+                continue
+            except OSError:
+                seen.add(name)
+                continue
+            seen.add(name)
+            if stat.S_ISREG(st.st_mode):
+                files.append((p, st))
+        if changed:
+            # mtime granularity hid a change; list this directory next time.
+            self.store.delete("dirs", d)
+        return snap.get("dirs", []), files, seen
+
+    def _scan_listing(self, d, dir_st, snap):
+        subdirs, files, seen = [], [], set()
+        try:
+            with os.scandir(d) as it:
+                for entry in it:
+                    seen.add(entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.name)
+                        elif entry.is_file():
+                            # DirEntry.stat() leaves st_ino/st_dev empty on Windows.
+                            st = os.stat(entry.path) if os.name == "nt" else entry.stat()
+                            files.append((entry.path, st))
+                    except OSError:
+                        pass
+        except OSError:
+            return [], [], None
+        if snap:
+            for sub in set(snap.get("dirs", [])) - set(subdirs):
+                self._forget_snapshot(os.path.join(d, sub))
+        names = [os.path.basename(p) for p, _ in files]
+        self.store.put("dirs", d, {"mtime_ns": dir_st.st_mtime_ns, "dirs": subdirs, "files": names})
+        return subdirs, files, seen
+
+    def _forget_snapshot(self, d):
+        snap = self.store.get("dirs", d)
+        if not snap:
+            return
+        self.store.delete("dirs", d)
+        for sub in snap.get("dirs", []):
+            self._forget_snapshot(os.path.join(d, sub))
+
+    def _sync_batch(self, items, before_upload=None, tally=None):
+        pending = {}
+        lookup = False
+        for p, st in items:
+            with self._lock:
+                existing = self.db["files"].get(p)
+            if existing and not self.paranoid and stat_matches(existing, st):
+                continue
+            self.hydrate(p)
+            pending[p] = st
+            # Only a file without a known Drive ID needs a name lookup.
+            lookup = lookup or not (existing and existing.get("id"))
+        if lookup and before_upload:
+            before_upload()
+        for p, digest in self.hasher.hash_many(list(pending)):
+            fn = tally.wrap(self.sync_file) if tally else self.sync_file
+            self._schedule(self.uploads, p, fn, p, known=(pending[p], digest),
+                           priority=BACKGROUND, cost=pending[p].st_size)
+
+    # Work is scheduled per sync root: watcher events (INTERACTIVE) run
+    # before replays (NORMAL) and full syncs (BACKGROUND), smaller files run
+    # first, and roots in the same class share workers fairly by weight.
+    def _schedule(self, executor, keys, fn, *args, priority=INTERACTIVE, cost=0, **kwargs):
+        path = keys if isinstance(keys, str) else keys[0]
+        return executor.schedule(keys, fn, args, kwargs, priority, self._find_sync_root(path), cost)
+
+    def set_root_weight(self, local_folder, weight):
+        local_folder = os.path.abspath(local_folder)
+        self.hashing.set_weight(local_folder, weight)
+        self.uploads.set_weight(local_folder, weight)
+
+    # Watcher events pass through the hash stage and then the upload stage.
+    # Both stages are keyed by path, and deletes/moves go through the hash
+    # stage too, so per-path ordering survives the hand-off.
+    def enqueue_sync(self, path, priority=INTERACTIVE):
+        path = os.path.abspath(path)
+        self._schedule(self.hashing, path, self._hash_stage, path, priority, priority=priority)
+
+    def enqueue_delete(self, path, tally=None):
+        path = os.path.abspath(path)
+        fn = tally.wrap(self.delete_file) if tally else self.delete_file
+        self._schedule(self.hashing, path, self._schedule, self.uploads, path, fn, path)
+
+    def enqueue_move(self, old_path, new_path):
+        old_path = os.path.abspath(old_path)
+        new_path = os.path.abspath(new_path)
+        keys = (old_path, new_path)
+        self._schedule(self.hashing, keys, self._schedule, self.uploads, keys, self.move_file, old_path, new_path)
+
+    def _hash_stage(self, path, priority=INTERACTIVE):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        if not stat.S_ISREG(st.st_mode):
+            return
+        with self._lock:
+            existing = self.db["files"].get(path)
+        if existing and not self.paranoid and stat_matches(existing, st):
+            return
+        self.hydrate(path)
+        self._schedule(self.uploads, path, self.sync_file, path, known=(st, self.file_hash(path)),
+                       priority=priority, cost=st.st_size)
+
+    def request_rescan(self, local_folder):
+        local_folder = os.path.abspath(local_folder)
+        with self._lock:
+            if local_folder in self._rescans:
+                return
+            self._rescans.add(local_folder)
+
+        def run():
+            try:
+                self.sync_folder(local_folder)
+            finally:
+                with self._lock:
+                    self._rescans.discard(local_folder)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def stats(self):
+        return {
+            "hash_queue": self.hashing.pending,
+            "upload_queue": self.uploads.pending,
+            "upload_by_class": self.uploads.pending_by_class(),
+            "dedup_copies": self.dedup_copies,
+            "bytes_saved": self.bytes_saved,
+            "bytes_uploaded": self.drive.bandwidth.bytes_sent,
+        }
+
+    # Sizes plus up to limit entries of the biggest in-memory tables; only
+    # references are copied while the lock is held.
+    def table_samples(self, limit):
+        with self._lock:
+            tables = {f"db[{t!r}]": self.db[t] for t in ("files", "folders")}
+            tables.update(_by_hash=self._by_hash, _by_id=self._by_id)
+            return {name: (len(data), list(islice(data.items(), limit))) for name, data in tables.items()}
+
+    def wait_idle(self, timeout=None):
+        return self.hashing.wait_idle(timeout) and self.uploads.wait_idle(timeout)
+
     def delete_file(self, path):
         path = os.path.abspath(path)
+        with self._lock:
+            entry = self.db["files"].get(path)
+            is_folder = not entry and path in self._folder_index
+        if is_folder:
+            return self.delete_folder(path)
         with self._lock:
             entry = self.db["files"].get(path)
             if not entry:
                 return
-            file_id = entry.get("id")
-        try:
-            if file_id:
-                self.drive.delete_file(file_id)
-        except:
-            pass
+            parent_id = self.db["folders"].get(os.path.dirname(path))
+            self._record_delete(entry, path)
+            self._drop_file(path)
+            if entry.get("id") and entry.get("size") is not None and entry.get("hash"):
+                self._park_delete(entry, parent_id)
+                return
+        if entry.get("id"):
+            self._delete_remote(entry["id"])
+
+    # Files inside a deleted directory usually arrive as their own deletes
+    # first; anything tracked that is still left (a directory moved out of
+    # the tree) is deleted here. Checking the disk keeps a directory that
+    # was recreated in the meantime. The Drive folder itself is left alone
+    # so held deletes under it can still pair into moves.
+    def delete_folder(self, local_folder):
+        local_folder = os.path.abspath(local_folder)
+        if os.path.isdir(local_folder):
+            return
+        prefix = local_folder + os.sep
         with self._lock:
-            if path in self.db["files"]:
-                del self.db["files"][path]
-                self.save_db()
+            paths = [p for p in self.db["files"] if p.startswith(prefix)]
+        for p in paths:
+            if not os.path.lexists(p):
+                self.delete_file(p)
+        self.unregister_folder(local_folder)
+
+    # A delete is written to the store together with the removal of its
+    # entry and cleared once Drive has answered, so one that never reached
+    # Drive (held, in flight, or lost to a crash) is replayed on the next start.
+    def _record_delete(self, entry, path):
+        if entry.get("id"):
+            self.store.put("deletes", entry["id"], {"path": path, "time": time.time()})
+
+    # Deletes are held for PAIR_WINDOW so that a delete followed by a create
+    # of identical content elsewhere (atomic saves, rsync, unzip) becomes a
+    # move of the existing Drive file instead of a delete plus a re-upload.
+    def _park_delete(self, entry, parent_id):
+        key = (entry["size"], entry["hash"])
+        self._parked.setdefault(key, deque()).append((time.monotonic() + PAIR_WINDOW, entry, parent_id))
+        if not self._reaper_started:
+            self._reaper_started = True
+            threading.Thread(target=self._reap_loop, name="delete-reaper", daemon=True).start()
+
+    def _claim_parked(self, size, h):
+        parked = self._parked.get((size, h))
+        if not parked:
+            return None
+        item = parked.popleft()
+        if not parked:
+            del self._parked[(size, h)]
+        return item
+
+    def _reap_parked(self, now):
+        expired = []
+        with self._lock:
+            for key in list(self._parked):
+                parked = self._parked[key]
+                while parked and parked[0][0] <= now:
+                    expired.append(parked.popleft()[1])
+                if not parked:
+                    del self._parked[key]
+        for entry in expired:
+            self._delete_remote(entry["id"])
+
+    def _reap_loop(self):
+        while not self._closed:
+            time.sleep(PAIR_WINDOW / 4)
+            self._reap_parked(time.monotonic())
 
     def move_file(self, old_path, new_path):
         old_path = os.path.abspath(old_path)
         new_path = os.path.abspath(new_path)
+        with self._lock:
+            is_folder = old_path in self._folder_index
+        if is_folder or os.path.isdir(new_path):
+            return self.move_folder(old_path, new_path)
         with self._lock:
             entry = self.db["files"].get(old_path)
-            if not entry:
+            replaced = self.db["files"].get(new_path) if new_path != old_path else None
+            old_parent = self.db["folders"].get(os.path.dirname(old_path))
+        new_parent = self._ensure_folder(os.path.dirname(new_path)) if entry else None
+        if not entry:
+            return self.sync_file(new_path)
+        if not new_parent:
+            return self.delete_file(old_path)
+        if replaced and replaced.get("id") and replaced.get("id") != entry.get("id"):
+            self._record_delete(replaced, new_path)
+            self._delete_remote(replaced["id"])
+        self._move_remote(entry["id"], os.path.basename(new_path), new_parent, old_parent)
+        with self._lock:
+            entry = self.db["files"].get(old_path)
+            if entry is None:
+                return
+            self._drop_file(old_path)
+            self._set_file(new_path, entry)
+
+    # A renamed or moved directory is one parent/name change on its Drive
+    # folder; the folders and files tracked under it are re-keyed in place.
+    def move_folder(self, old_path, new_path):
+        with self._lock:
+            folder_id = self.db["folders"].get(old_path)
+            old_parent = self.db["folders"].get(os.path.dirname(old_path))
+            if not folder_id and new_path in self.db["folders"]:
+                # Already handled along with a parent directory.
                 return
-            file_id = entry.get("id")
+        if not folder_id:
+            # Never synced (e.g. created and moved before we saw it).
+            root = self._find_sync_root(new_path)
+            if root:
+                self.request_rescan(root)
+            return
+        new_parent = self._ensure_folder(os.path.dirname(new_path))
+        if not new_parent:
+            return
+        self._move_remote(folder_id, os.path.basename(new_path), new_parent, old_parent)
+        prefix = old_path + os.sep
+        with self._lock:
+            for path in self._folder_index.remove_subtree(old_path):
+                moved_id = self.db["folders"].pop(path)
+                self.store.delete("folders", path)
+                self._set_folder(new_path + path[len(old_path):], moved_id)
+            for path in [p for p in self.db["files"] if p.startswith(prefix)]:
+                entry = self.db["files"][path]
+                self._drop_file(path)
+                self._set_file(new_path + path[len(old_path):], entry)
+            self._forget_snapshot(old_path)
+
+    # Operations that still fail once the client has given up retrying are
+    # kept in the dead_letters table and replayed on the next start.
+    def _dead_letter(self, op, key, error, **fields):
+        print("[DEAD LETTER]", op, key, error)
+        FILES.inc(outcome="dead_letter")
+        self.store.put("dead_letters", f"{op}:{key}", {
+            "op": op, "error": str(error), "time": time.time(), **fields
+        })
+
+    def _watch(self, fut, op, key, **fields):
+        with self._remote_done:
+            self._remote_ops += 1
+
+        def done(f):
+            try:
+                e = f.exception()
+                if e is not None and not is_not_found(e):
+                    self._dead_letter(op, key, e, **fields)
+                if op == "delete":
+                    self.store.delete("deletes", key)
+            finally:
+                self._remote_finished()
         try:
-            self.drive.rename_file(file_id, os.path.basename(new_path))
+            fut.add_done_callback(done)
         except:
-            pass
+            self._remote_finished()
+            raise
+
+    def _remote_finished(self):
+        with self._remote_done:
+            self._remote_ops -= 1
+            self._remote_done.notify_all()
+
+    def _delete_remote(self, file_id):
+        try:
+            self._watch(self.drive.delete_file(file_id, wait=False), "delete", file_id, file_id=file_id)
+        except Exception as e:
+            self._dead_letter("delete", file_id, e, file_id=file_id)
+            self.store.delete("deletes", file_id)
+
+    def _move_remote(self, file_id, name, add_parent, remove_parent):
+        fields = {"file_id": file_id, "name": name, "add_parent": add_parent, "remove_parent": remove_parent}
+        try:
+            self._watch(self.drive.move_file(file_id, name, add_parent, remove_parent, wait=False),
+                        "move", file_id, **fields)
+        except Exception as e:
+            self._dead_letter("move", file_id, e, **fields)
+
+    def dead_letters(self):
+        self.store.flush()
+        return self.store.load("dead_letters")
+
+    # Dead letters are replayed off the caller's thread, at start and then
+    # every RETRY_INTERVAL, so work that failed during an outage goes out
+    # once Drive is reachable again.
+    def start_retrying(self):
+        with self._lock:
+            if self._retry_started:
+                return
+            self._retry_started = True
+        threading.Thread(target=self._retry_loop, name="dead-letter-retry", daemon=True).start()
+
+    def _retry_loop(self):
+        while not self._closed:
+            try:
+                self.retry_dead_letters()
+            except Exception as e:
+                print("[RETRY ERROR]", e)
+            self._stopping.wait(RETRY_INTERVAL)
+
+    def retry_dead_letters(self):
+        letters = self.dead_letters()
+        for key, letter in letters.items():
+            self.store.delete("dead_letters", key)
+            op = letter.get("op")
+            if op == "sync":
+                self.enqueue_sync(letter["path"], NORMAL)
+            elif op == "delete":
+                self._delete_remote(letter["file_id"])
+            elif op == "move":
+                self._move_remote(letter["file_id"], letter["name"], letter["add_parent"], letter["remove_parent"])
+            elif op == "folder" and os.path.isdir(letter["path"]):
+                path = letter["path"]
+                with self._lock:
+                    is_root = path in self._roots
+                folder_id = self.register_folder(path) if is_root else self._ensure_folder(path)
+                root = self._find_sync_root(path)
+                if folder_id and root:
+                    # Files under it were skipped while it had no Drive folder.
+                    self.request_rescan(root)
         with self._lock:
-            self.db["files"][new_path] = self.db["files"][old_path]
-            del self.db["files"][old_path]
-            self.save_db()
+            held = {entry["id"] for parked in self._parked.values() for _, entry, _ in parked}
+            deletes = []
+            for file_id in self.store.load("deletes"):
+                if file_id in self._by_id:
+                    # Tracked again (e.g. restored), so it must stay.
+                    self.store.delete("deletes", file_id)
+                elif file_id not in held:
+                    deletes.append(file_id)
+        for file_id in deletes:
+            self._delete_remote(file_id)
+        return len(letters) + len(deletes)
@@ -0,0 +1,147 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+
+from core import metrics
+
+GROUP_COMMIT_DELAY = 0.5
+TABLES = ("folders", "files", "meta", "uploads", "dirs", "dead_letters", "deletes")
+
+FLUSH_SECONDS = metrics.histogram("drivesync_store_flush_seconds", "Time to commit one group of tracking-store writes")
+FLUSH_ROWS = metrics.counter("drivesync_store_rows_total", "Rows written to the tracking store")
+
+
+def remove_store(path):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        except:
+            pass
+
+
+class TrackingStore:
+    def __init__(self, path, legacy_json=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        for table in TABLES:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+
+        if legacy_json and os.path.exists(legacy_json):
+            self._migrate(legacy_json)
+
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _migrate(self, legacy_json):
+        with self._flush_lock:
+            row = self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM folders) + (SELECT COUNT(*) FROM files)"
+            ).fetchone()
+            if row[0]:
+                return
+            try:
+                with open(legacy_json, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+            except:
+                return
+            self._conn.execute("BEGIN")
+            try:
+                for table in ("folders", "files"):
+                    self._conn.executemany(
+                        f"INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)",
+                        [(k, json.dumps(v, ensure_ascii=False)) for k, v in data.get(table, {}).items()]
+                    )
+                self._conn.execute("COMMIT")
+            except:
+                self._conn.execute("ROLLBACK")
+                return
+        try:
+            os.replace(legacy_json, legacy_json + ".migrated")
+        except:
+            pass
+
+    def load(self, table):
+        with self._flush_lock:
+            rows = self._conn.execute(f"SELECT key, value FROM {table}").fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def get(self, table, key, default=None):
+        with self._lock:
+            if (table, key) in self._pending:
+                value = self._pending[(table, key)]
+                return default if value is None else value
+        with self._flush_lock:
+            row = self._conn.execute(f"SELECT value FROM {table} WHERE key=?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, table, key, value):
+        with self._lock:
+            self._pending[(table, key)] = value
+        self._wake.set()
+
+    def delete(self, table, key):
+        self.put(table, key, None)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending or self._closed:
+                return
+            start = time.perf_counter()
+            try:
+                self._conn.execute("BEGIN")
+                for (table, key), value in pending.items():
+                    if value is None:
+                        self._conn.execute(f"DELETE FROM {table} WHERE key=?", (key,))
+                    else:
+                        self._conn.execute(
+                            f"INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)",
+                            (key, json.dumps(value, ensure_ascii=False))
+                        )
+                self._conn.execute("COMMIT")
+                FLUSH_SECONDS.observe(time.perf_counter() - start)
+                FLUSH_ROWS.inc(len(pending))
+            except Exception as e:
+                print("[TRACKING DB ERROR]", e)
+                try:
+                    self._conn.execute("ROLLBACK")
+                except:
+                    pass
+                with self._lock:
+                    for k, v in pending.items():
+                        self._pending.setdefault(k, v)
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait()
+            if self._closed:
+                return
+            self._wake.clear()
+            # Let the rest of a burst land so it shares one transaction / fsync.
+            time.sleep(GROUP_COMMIT_DELAY)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        with self._flush_lock:
+            self._closed = True
+            self._wake.set()
+            try:
+                self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                self._conn.close()
+            except:
+                pass
@@ -0,0 +1,45 @@
+import json
+import threading
+import httplib2
+import google_auth_httplib2
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+
+HTTP_TIMEOUT = 120
+
+
+class DriveTransport:
+    # httplib2.Http is not thread-safe, so each thread gets its own authorized
+    # Http and service object. Each Http keeps its TLS connection alive between
+    # calls, and all services are built from one parsed discovery document.
+    def __init__(self, creds, timeout=HTTP_TIMEOUT):
+        self.creds = creds
+        self.timeout = timeout
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._document = None
+        self.services_built = 0
+
+    def _discovery(self):
+        with self._lock:
+            if self._document is None:
+                doc = get_static_doc("drive", "v3")
+                self._document = json.loads(doc) if doc else False
+            return self._document
+
+    def http(self):
+        return google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http(timeout=self.timeout))
+
+    @property
+    def service(self):
+        service = getattr(self._local, "service", None)
+        if service is None:
+            document = self._discovery()
+            if document:
+                service = build_from_document(document, http=self.http())
+            else:
+                service = build("drive", "v3", http=self.http())
+            self._local.service = service
+            with self._lock:
+                self.services_built += 1
+        return service
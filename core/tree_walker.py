@@ -0,0 +1,59 @@
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+WALK_WORKERS = 8
+WALK_QUEUE_SIZE = 1024
+
+_DONE = object()
+
+
+def walk_parallel(root, scan_dir, workers=WALK_WORKERS):
+    # scan_dir(path) returns a record whose second item is the list of
+    # subdirectory paths, or None to skip. Listings run on a thread pool and
+    # records are yielded as they finish; a directory's record is always
+    # yielded before any of its children's.
+    out = queue.Queue(maxsize=WALK_QUEUE_SIZE)
+    lock = threading.Lock()
+    outstanding = [1]
+    cancelled = threading.Event()
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="walk")
+
+    def put(item):
+        while not cancelled.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def visit(path):
+        try:
+            record = None if cancelled.is_set() else scan_dir(path)
+        except Exception:
+            traceback.print_exc()
+            record = None
+        if record is not None and put(record):
+            subs = record[1]
+            with lock:
+                outstanding[0] += len(subs)
+            for sub in subs:
+                pool.submit(visit, sub)
+        with lock:
+            outstanding[0] -= 1
+            finished = outstanding[0] == 0
+        if finished:
+            put(_DONE)
+
+    pool.submit(visit, root)
+    try:
+        while True:
+            item = out.get()
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False)
@@ -0,0 +1,206 @@
+import heapq
+import itertools
+import threading
+import traceback
+from collections import deque
+
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+TASK_COST = 256 * 1024
+
+
+class _Task:
+    __slots__ = ("keys", "fn", "args", "kwargs", "queued", "priority", "group", "cost")
+
+    def __init__(self, keys, fn, args, kwargs, priority=NORMAL, group=None, cost=0):
+        self.keys = keys
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.queued = False
+        self.priority = priority
+        self.group = group
+        self.cost = cost
+
+
+class FairScheduler:
+    # Ready tasks by priority class, then by group (a sync root). A lower
+    # class always runs first. Within a class, groups share the workers by
+    # weighted fair queuing on task cost (bytes plus TASK_COST), and each
+    # group runs its cheapest tasks first.
+    def __init__(self):
+        self.weights = {}
+        self._classes = {}
+        self._vtime = {}
+        self._idle = set()
+        self._clock = 0
+        self._seq = itertools.count()
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def push(self, task):
+        groups = self._classes.setdefault(task.priority, {})
+        heap = groups.get(task.group)
+        if heap is None:
+            heap = groups[task.group] = []
+            # An idle group rejoins at the current clock so it cannot bank
+            # credit while it had nothing queued.
+            self._vtime[task.group] = max(self._vtime.get(task.group, 0), self._clock)
+            self._idle.discard(task.group)
+        heapq.heappush(heap, (task.cost, next(self._seq), task))
+        self._len += 1
+
+    def pop(self):
+        priority = min(self._classes)
+        groups = self._classes[priority]
+        group = min(groups, key=self._vtime.__getitem__)
+        heap = groups[group]
+        cost, _, task = heapq.heappop(heap)
+        if not heap:
+            del groups[group]
+            if not groups:
+                del self._classes[priority]
+        self._clock = self._vtime[group]
+        self._vtime[group] += (cost + TASK_COST) / self.weights.get(group, 1)
+        self._len -= 1
+        if not self._len:
+            # Nothing is queued anywhere: start a fresh busy period.
+            self._vtime.clear()
+            self._idle.clear()
+            self._clock = 0
+            return task
+        if not heap and not any(group in g for g in self._classes.values()):
+            self._idle.add(group)
+        # A group with nothing queued only needs its virtual time while it is
+        # still ahead of the clock; after that it would rejoin at the clock.
+        for g in [g for g in self._idle if self._vtime[g] <= self._clock]:
+            del self._vtime[g]
+            self._idle.discard(g)
+        return task
+
+
+class TaskTally:
+    # Counts the tasks one caller handed out (each fn passed through wrap),
+    # so it can wait for just those while other work keeps the pools busy.
+    def __init__(self):
+        self.count = 0
+        self._cond = threading.Condition()
+
+    def wrap(self, fn):
+        with self._cond:
+            self.count += 1
+
+        def run(*args, **kwargs):
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._cond:
+                    self.count -= 1
+                    self._cond.notify_all()
+        return run
+
+    def wait(self, stop=lambda: False, poll=1.0):
+        # stop is polled so a task dropped by a shut-down pool can't hang us.
+        with self._cond:
+            while self.count and not stop():
+                self._cond.wait(poll)
+        return not self.count
+
+
+class KeyedExecutor:
+    # Tasks sharing a key run one at a time in submission order; a task with
+    # several keys (a move) waits until it is at the head of every key's queue.
+    # Among tasks that are ready, the FairScheduler picks what runs next.
+    def __init__(self, workers, name="worker", max_pending=0):
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._queues = {}
+        self._ready = FairScheduler()
+        self._pending = 0
+        self._by_class = {}
+        self._shutdown = False
+        self._threads = [
+            threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def pending_by_class(self):
+        with self._cond:
+            return dict(self._by_class)
+
+    def set_weight(self, group, weight):
+        with self._cond:
+            self._ready.weights[group] = max(weight, 0.01)
+
+    def submit(self, keys, fn, *args, **kwargs):
+        return self.schedule(keys, fn, args, kwargs)
+
+    def schedule(self, keys, fn, args=(), kwargs=None, priority=NORMAL, group=None, cost=0):
+        if isinstance(keys, str):
+            keys = (keys,)
+        task = _Task(tuple(dict.fromkeys(keys)), fn, args, kwargs or {}, priority, group, cost)
+        with self._cond:
+            # Backpressure is per class, so a bulk sync filling the queue
+            # never blocks an interactive edit from being queued.
+            while (self.max_pending and self._by_class.get(priority, 0) >= self.max_pending
+                   and not self._shutdown):
+                self._cond.wait()
+            if self._shutdown:
+                return False
+            for k in task.keys:
+                self._queues.setdefault(k, deque()).append(task)
+            self._pending += 1
+            self._by_class[priority] = self._by_class.get(priority, 0) + 1
+            self._mark_ready(task)
+        return True
+
+    def _mark_ready(self, task):
+        if task.queued:
+            return
+        if all(self._queues[k][0] is task for k in task.keys):
+            task.queued = True
+            self._ready.push(task)
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._shutdown:
+                    self._cond.wait()
+                if self._shutdown:
+                    return
+                task = self._ready.pop()
+            try:
+                task.fn(*task.args, **task.kwargs)
+            except Exception:
+                traceback.print_exc()
+            with self._cond:
+                for k in task.keys:
+                    q = self._queues[k]
+                    q.popleft()
+                    if q:
+                        self._mark_ready(q[0])
+                    else:
+                        del self._queues[k]
+                self._pending -= 1
+                self._by_class[task.priority] -= 1
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout=None):
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0 or self._shutdown, timeout)
+
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
@@ -2,11 +2,23 @@ import sys
 import os
 from pathlib import Path
 from PyQt6.QtWidgets import QApplication, QSystemTrayIcon, QMenu, QMessageBox
+from PyQt6.QtCore import QTimer
 from PyQt6.QtGui import QIcon
 
 from ui.login_window import LoginWindow
 from ui.main_window import MainWindow, TOKEN_JSON
 from core.google_auth import GoogleAuth
+from core.metrics import start_exporters
+from core.profiler import Profiler, install_signal
+
+UPLOAD_LIMITS = (
+    ("Follow Schedule", None),
+    ("Unlimited", 0),
+    ("256 KiB/s", 256),
+    ("1 MiB/s", 1024),
+    ("5 MiB/s", 5 * 1024),
+)
+
 
 def resource_path(relative_path):
     if hasattr(sys, "_MEIPASS"):
@@ -17,6 +29,7 @@ def resource_path(relative_path):
 class TrayApp:
     def __init__(self):
         self.app = QApplication(sys.argv)
+        start_exporters()
 
         icon = QIcon(resource_path("assets/icon.ico"))
         self.tray = QSystemTrayIcon(icon)
@@ -24,6 +37,12 @@ class TrayApp:
 
         menu = QMenu()
         open_action = menu.addAction("Open DriveSync")
+        limit_menu = menu.addMenu("Upload Limit")
+        for label, kib in UPLOAD_LIMITS:
+            action = limit_menu.addAction(label)
+            action.triggered.connect(lambda _, kib=kib: self.main_window.set_upload_limit(kib))
+        self.profile_action = menu.addAction("Start Profiling")
+        self.profile_action.triggered.connect(self.toggle_profiling)
         quit_action = menu.addAction("Quit")
         open_action.triggered.connect(self.open_app)
         quit_action.triggered.connect(self.quit)
@@ -38,6 +57,16 @@ class TrayApp:
         self.main_window.set_tray(self.tray)
         self.main_window.hide()
 
+        self.profiler = Profiler(lambda: self.main_window.sync_engine)
+        if install_signal(self.toggle_profiling):
+            # Qt's event loop keeps Python from running signal handlers; a
+            # periodic no-op timer gives it the chance.
+            self._signal_timer = QTimer()
+            self._signal_timer.timeout.connect(lambda: None)
+            self._signal_timer.start(500)
+        if os.environ.get("DRIVESYNC_PROFILE") == "1":
+            self.toggle_profiling()
+
         self.auth = GoogleAuth()
         self.login_window.loginRequested.connect(self.do_login)
 
@@ -64,6 +93,12 @@ class TrayApp:
             self.main_window.show()
             self.main_window.raise_()
 
+    def toggle_profiling(self):
+        out = self.profiler.toggle()
+        self.profile_action.setText("Stop Profiling" if self.profiler.running else "Start Profiling")
+        if out:
+            self.tray.showMessage("DriveSync", f"Profile written to {out}.*")
+
     def do_login(self):
         creds = self.auth.login()
         if creds:
@@ -75,6 +110,8 @@ class TrayApp:
             self.main_window.show()
 
     def quit(self):
+        if self.profiler.running:
+            self.profiler.stop()
         try:
             for w in list(self.main_window.watchers.values()):
                 w.stop()
@@ -82,6 +119,7 @@ class TrayApp:
             pass
 
         self.main_window.watchers.clear()
+        self.main_window.close_engine()
         self.tray.hide()
         sys.exit()
 
@@ -16,6 +16,10 @@ from PyQt6.QtGui import QAction, QIcon
 from core.folder_watcher import FolderWatcher
 from core.sync_engine import SyncEngine
 from core.drive_client import DriveClient
+from core.bandwidth import UPLOAD_LIMIT_KIB, UPLOAD_SCHEDULE
+from core.tracking_store import remove_store
+from core.remote_changes import RemoteChangePoller
+from core.restore import Restorer
 
 if platform.system() == "Windows":
     APP_DATA_DIR = Path(os.getenv("APPDATA")) / "DriveSync"
@@ -26,7 +30,8 @@ APP_DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 SYNCED_JSON = str(APP_DATA_DIR / "synced_folders.json")
 TOKEN_JSON = str(APP_DATA_DIR / "token.json")
-TRACKING_DB = str(APP_DATA_DIR / "sync_tracking.json")
+TRACKING_DB = str(APP_DATA_DIR / "sync_tracking.db")
+LEGACY_TRACKING_JSON = str(APP_DATA_DIR / "sync_tracking.json")
 
 def resource_path(relative_path):
     if hasattr(sys, "_MEIPASS"):
@@ -123,6 +128,8 @@ class MainWindow(QWidget):
         self.creds = None
         self.drive_client = None
         self.sync_engine = None
+        self.remote_poller = None
+        self.upload_limit = None
         self.watchers = {}
         self.tray = None
         self.login_window_ref = None
@@ -137,11 +144,44 @@ class MainWindow(QWidget):
 
     def set_credentials(self, creds):
         self.creds = creds
+        self.close_engine()
         self.drive_client = DriveClient(creds)
+        self.set_upload_limit(self.upload_limit)
         self.sync_engine = SyncEngine(self.drive_client)
+        self.remote_poller = RemoteChangePoller(
+            self.drive_client, self.sync_engine, self._on_remote_changes
+        )
+        self.remote_poller.start()
         self.add_btn.setEnabled(True)
         self.status_label.setText("Ready to Sync")
 
+    # kib is a fixed limit in KiB/s (0 = unlimited); None follows the configured schedule.
+    def set_upload_limit(self, kib):
+        self.upload_limit = kib
+        if not self.drive_client:
+            return
+        bandwidth = self.drive_client.bandwidth
+        if kib is None:
+            bandwidth.set_rate(UPLOAD_LIMIT_KIB * 1024)
+            bandwidth.set_schedule(UPLOAD_SCHEDULE)
+        else:
+            bandwidth.set_schedule([])
+            bandwidth.set_rate(kib * 1024)
+
+    def _on_remote_changes(self, changes):
+        for change in changes:
+            print("[REMOTE]", change["action"], change["path"])
+        self.status_updated.emit(f"Remote changes detected: {len(changes)}")
+
+    def close_engine(self):
+        if self.remote_poller:
+            self.remote_poller.stop()
+            self.remote_poller = None
+        if self.sync_engine:
+            try: self.sync_engine.close()
+            except: pass
+        self.sync_engine = None
+
     def enable_sync_ui(self):
         self.add_btn.setEnabled(True)
         self.remove_btn.setEnabled(bool(self.list_widget.selectedItems()))
@@ -149,6 +189,8 @@ class MainWindow(QWidget):
         for folder in self._get_persisted_folders():
             if os.path.isdir(folder) and folder not in self.watchers:
                 self._start_sync_for(folder)
+        if self.sync_engine:
+            self.sync_engine.start_retrying()
 
     def select_folder(self):
         folder = QFileDialog.getExistingDirectory(self, "Select Folder to Sync")
@@ -167,22 +209,18 @@ class MainWindow(QWidget):
             self.status_updated.emit("ERROR: Sync engine not initialized.")
             return
 
+        self.sync_engine.add_root(folder)
         self.sync_engine.register_folder(folder)
 
         def do_full_sync():
-            try:
-                self.status_updated.emit(f"Full sync started: {folder}")
-                self.sync_engine.sync_folder(folder)
-                self.status_updated.emit(f"Full sync completed: {folder}")
-            except Exception as e:
-                self.status_updated.emit(f"Sync error: {e}")
-
+            # Arm the watcher first so nothing changed during the scan is missed.
             try:
                 watcher = FolderWatcher(
                     folder,
-                    self.sync_engine.sync_file,
-                    self.sync_engine.delete_file,
-                    self.sync_engine.move_file
+                    self.sync_engine.enqueue_sync,
+                    self.sync_engine.enqueue_delete,
+                    self.sync_engine.enqueue_move,
+                    lambda: self.sync_engine.request_rescan(folder)
                 )
                 watcher.start()
                 self.watchers[folder] = watcher
@@ -190,6 +228,13 @@ class MainWindow(QWidget):
             except Exception as e:
                 self.status_updated.emit(f"Watcher error: {e}")
 
+            try:
+                self.status_updated.emit(f"Full sync started: {folder}")
+                self.sync_engine.sync_folder(folder)
+                self.status_updated.emit(f"Full sync completed: {folder}")
+            except Exception as e:
+                self.status_updated.emit(f"Sync error: {e}")
+
         Thread(target=do_full_sync, daemon=True).start()
 
     def remove_selected(self):
@@ -208,6 +253,8 @@ class MainWindow(QWidget):
             if folder in self.watchers:
                 self.watchers[folder].stop()
                 del self.watchers[folder]
+            if self.sync_engine:
+                self.sync_engine.unregister_folder(folder)
             self.list_widget.takeItem(self.list_widget.row(it))
 
         self._save_synced_json()
@@ -254,10 +301,13 @@ class MainWindow(QWidget):
         menu = QMenu(self)
         open_action = QAction("Open Folder", self)
         open_action.triggered.connect(lambda: self._open_folder(folder))
+        restore_action = QAction("Restore from Drive", self)
+        restore_action.triggered.connect(lambda: self._restore_folder(folder))
         remove_action = QAction("Remove", self)
         remove_action.triggered.connect(lambda: self._remove_single(folder))
 
         menu.addAction(open_action)
+        menu.addAction(restore_action)
         menu.addAction(remove_action)
         menu.exec(self.list_widget.mapToGlobal(pos))
 
@@ -272,6 +322,26 @@ class MainWindow(QWidget):
         except:
             pass
 
+    def _restore_folder(self, folder):
+        if not self.sync_engine:
+            self.status_updated.emit("ERROR: Sync engine not initialized.")
+            return
+
+        def progress(done, downloaded, failed):
+            self.status_updated.emit(f"Restoring {folder}: {downloaded} downloaded, {failed} failed, {done} checked")
+
+        def do_restore():
+            try:
+                restorer = Restorer(self.drive_client, self.sync_engine, on_progress=progress)
+                if restorer.restore(folder):
+                    self.status_updated.emit(f"Restore completed: {folder}")
+                else:
+                    self.status_updated.emit(f"Restore finished with errors: {folder}")
+            except Exception as e:
+                self.status_updated.emit(f"Restore error: {e}")
+
+        Thread(target=do_restore, daemon=True).start()
+
     def _open_folder_for_item(self, item):
         self._open_folder(item.text())
 
@@ -316,7 +386,7 @@ class MainWindow(QWidget):
 
         self.creds = None
         self.drive_client = None
-        self.sync_engine = None
+        self.close_engine()
 
         self.list_widget.clear()
         self._save_synced_json()
@@ -367,16 +437,17 @@ class MainWindow(QWidget):
             try: w.stop()
             except: pass
         self.watchers.clear()
+        self.close_engine()
 
         try:
             if os.path.exists(SYNCED_JSON): os.remove(SYNCED_JSON)
-            if os.path.exists(TRACKING_DB): os.remove(TRACKING_DB)
+            if os.path.exists(LEGACY_TRACKING_JSON): os.remove(LEGACY_TRACKING_JSON)
+            remove_store(TRACKING_DB)
         except:
             pass
 
         self.list_widget.clear()
 
-        self.sync_engine = None
         self.drive_client = None
 
         self.set_credentials(self.creds)
@@ -400,16 +471,17 @@ class MainWindow(QWidget):
             try: w.stop()
             except: pass
         self.watchers.clear()
+        self.close_engine()
 
         try:
             if os.path.exists(SYNCED_JSON): os.remove(SYNCED_JSON)
-            if os.path.exists(TRACKING_DB): os.remove(TRACKING_DB)
+            if os.path.exists(LEGACY_TRACKING_JSON): os.remove(LEGACY_TRACKING_JSON)
+            remove_store(TRACKING_DB)
             if os.path.exists(TOKEN_JSON): os.remove(TOKEN_JSON)
         except:
             pass
 
         self.list_widget.clear()
-        self.sync_engine = None
         self.drive_client = None
         self.creds = None
 